@@ -1,8 +1,106 @@
+import argparse
+import re
 import socket
+import struct
 import threading
 import os
 import time
 
+FRAMED = False # Use length prefixed frames, the server must be started with --framed too
+FRAME_HEADER = struct.Struct("!I") # 4 byte big endian message length
+olderHistory = None # (channel, id) from the last HISTORY_MORE message, where /history continues from
+HISTORY_MORE_PATTERN = re.compile(r"^HISTORY_MORE:(.*):(\d+)\n", re.MULTILINE) # A line of its own, also inside a history replay that came in one piece
+sessionToken = None # Token from the last SESSION message, used to resume the session when the connection drops
+SESSION_PATTERN = re.compile(r"SESSION:([\w-]{22})") # The server's tokens are always 22 characters, so the token can be found even when it is glued to other messages
+RESUME_ATTEMPTS = 5 # Reconnect attempts before giving up
+RESUME_DELAY = 2 # Seconds between reconnect attempts
+
+# Socket wrapper that sends and receives length prefixed frames
+# recv returns exactly one message no matter how TCP split or joined the data
+class FramedSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray() # Bytes received but not yet returned as a message
+
+    def send(self, data):
+        self.sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+        return len(data)
+
+    def recv(self, bufsize): # bufsize is only the read size, messages are never truncated
+        while True:
+            if len(self.buffer) >= FRAME_HEADER.size:
+                (length,) = FRAME_HEADER.unpack_from(self.buffer)
+                end = FRAME_HEADER.size + length
+                if len(self.buffer) >= end: # Whole message is in the buffer
+                    message = bytes(self.buffer[FRAME_HEADER.size:end])
+                    del self.buffer[:end]
+                    return message
+            data = self.sock.recv(bufsize)
+            if not data:
+                return b"" # Server closed the connection
+            self.buffer += data
+
+    def close(self):
+        self.sock.close()
+
+# Socket wrapper that can reconnect after the connection drops and take the old session back with the resume token
+class ResumableSocket:
+    def __init__(self, address, sock):
+        self.address = address
+        self.sock = sock
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def close(self):
+        self.sock.close()
+
+    def resume(self): # Returns True if the server gave the session back
+        for attempt in range(RESUME_ATTEMPTS):
+            time.sleep(RESUME_DELAY)
+            print("Reconnecting...")
+            sock = connectToServer(self.address)
+            if not sock:
+                continue
+            try:
+                sock.send(f"RESUME:{sessionToken}".encode("utf-8")) # Send the resume token instead of a nickname
+                response = sock.recv(1024).decode("utf-8")
+            except socket.error:
+                continue
+            response = takeSessionToken(response) # The new token, the old one doesn't work anymore
+            print(response)
+            if not response.startswith("INFO:"): # Session expired, a new login is needed
+                sock.close()
+                return False
+            self.sock = sock
+            return True
+        return False
+
+# Helper function for taking the resume token out of a response, returns the response without it
+# Without framing the SESSION message comes glued to the Welcome message and the history after it
+def takeSessionToken(message):
+    global sessionToken
+    match = SESSION_PATTERN.search(message)
+    if not match:
+        return message
+    sessionToken = match.group(1)
+    return message[:match.start()] + message[match.end():]
+
+# Helper function for keeping track of where /history continues, returns the message without the HISTORY_MORE line
+# Every page of history replaces the position, a page without the line or "No older messages" means the start was reached
+def trackOlderHistory(message):
+    global olderHistory
+    if "--- Begin History ---" in message or "No older messages" in message:
+        olderHistory = None
+    match = HISTORY_MORE_PATTERN.search(message)
+    if not match:
+        return message
+    olderHistory = (match.group(1), match.group(2))
+    print("Older messages available, use /history to load them")
+    return message[:match.start()] + message[match.end():]
 
 # Function to connect to the server
 # Takes the address as a string in the format "host:port"
@@ -21,6 +119,8 @@ def connectToServer(address):
         clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         clientSocket.connect((host, port))
         print(f"Connected to server at {host}:{port}")
+        if FRAMED:
+            return FramedSocket(clientSocket)
         return clientSocket
     except socket.error as e:
         print(f"Error connecting to server: {e}")
@@ -72,16 +172,35 @@ def listChannelsandClients(clientSocket, message):
         print(f"Error listing clients or channels: {e}")
         return False
 
+# Function for loading older messages of the channel
+def requestHistory(clientSocket, count):
+    if not olderHistory:
+        print("No older messages to load")
+        return False
+    channel, beforeId = olderHistory
+    try:
+        clientSocket.send(f"HISTORY:{channel}:{beforeId}:{count}".encode("utf-8")) # Send HISTORY command
+        return True
+    except Exception as e: # Catch any errors and return False
+        print(f"Error loading history: {e}")
+        return False
+
 # Function for receiving messages from server
 def receiveMessages(clientSocket, runningEvent):
+    global olderHistory, sessionToken
     try:
         while runningEvent.is_set():
             try:
                 message = clientSocket.recv(1024).decode("utf-8")
                 if not message:
                     print("Connection to server lost")
+                    if runningEvent.is_set() and sessionToken and clientSocket.resume(): # Continue with the same nickname and channel
+                        continue
                     runningEvent.clear()
                     return
+                message = trackOlderHistory(message)
+                if not message:
+                    continue
                 
                 # For regular messages
                 if message.startswith("MSG:"):
@@ -175,6 +294,12 @@ def receiveMessages(clientSocket, runningEvent):
                         #Fallback if something goes wrong
                         print(f"History: {message[8:]}\n")
                 
+                # For the resume token, replaced by a new one after every resume
+                elif message.startswith("SESSION:"):
+                    message = takeSessionToken(message)
+                    if message:
+                        print(message) # Messages that came in the same read
+                
                 # For any other message type
                 else:
                     print(message)
@@ -183,6 +308,8 @@ def receiveMessages(clientSocket, runningEvent):
                 # Only show connection error if we're still supposed to be running
                 if runningEvent.is_set():
                     print("Connection error")
+                    if sessionToken and clientSocket.resume(): # Continue with the same nickname and channel
+                        continue
                 runningEvent.clear()
                 return
                 
@@ -196,6 +323,7 @@ def helpmenu(): # Display help menu
     print("/dm <client> <message> - Send a direct message to a user")
     print("/list channels - List available channels")
     print("/list clients - List online clients")
+    print("/history [count] - Load older messages of the channel")
     print("/quit - Disconnect from the server")
     print("/help - Show help menu with available commands")
     print("Type your message and press Enter to send to the current channel\n")
@@ -222,6 +350,7 @@ def disconnect(clientSocket, runningEvent):
         print(f"Error during disconnect: {e}")
 
 def main():
+    global olderHistory
     # Get server address
     serverInput = input("Enter server address or press enter to use default (127.0.0.1:3000): ")
     
@@ -247,11 +376,12 @@ def main():
                     print(response) # Print error message if nickname is invalid
                     nickname = None
                 else:
-                    print(response) # Print success message if nickname is valid
+                    print(takeSessionToken(response)) # Print success message if nickname is valid
             except Exception as e: # Catch any errors while setting nickname
                 print(f"Error setting nickname: {e}") 
                 return
     
+    clientSocket = ResumableSocket(serverAddress, clientSocket) # Lets the receive thread reconnect if the connection drops
     runningEvent = threading.Event() # Create an event to control the receive thread
     runningEvent.set() # Set the event to indicate that the thread should run
  
@@ -272,6 +402,7 @@ def main():
                 cmd = command[0].upper() # Get command in uppercase to handle case insensitivity
 
                 if cmd == "JOIN" and len(command) > 1: # Join a channel
+                    olderHistory = None # History markers of the old channel don't apply anymore
                     channel = command[1]
                     # Clear screen before joining - makes history more readable
                     clearScreen()
@@ -289,6 +420,12 @@ def main():
                         listChannelsandClients(clientSocket, "CLIENTS") # List clients
                     else:
                         print("Invalid list command. Use: /list channels or /list clients") # Print error message if command is invalid
+                elif cmd == "HISTORY": # Load older messages
+                    count = command[1] if len(command) > 1 else "20"
+                    if count.isdigit():
+                        requestHistory(clientSocket, count)
+                    else:
+                        print("Invalid history command. Use: /history [count]")
                 elif cmd == "QUIT": # Disconnect from server
                     disconnect(clientSocket, runningEvent)
                 elif cmd == "HELP": # Show help menu
@@ -305,4 +442,8 @@ def main():
         if runningEvent.is_set():
             disconnect(clientSocket, runningEvent)
 
-main() # Runs main function
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat client")
+    parser.add_argument("--framed", action="store_true", default=FRAMED, help="Use length prefixed message framing, the server must use --framed too")
+    FRAMED = parser.parse_args().framed
+    main() # Runs main function
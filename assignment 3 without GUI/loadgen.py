@@ -0,0 +1,277 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+FRAME_HEADER = struct.Struct("!I") # Same 4 byte length prefix as the server
+MARKER = re.compile(rb"@lg(\w+)-(\d+)-(\d+)@") # Run id, sender index and scheduled send time in ns, put in every test message
+CONNECT_CONCURRENCY = 100 # Connections opened at the same time while ramping up
+SAMPLE_INTERVAL = 0.5 # Seconds between server CPU and memory samples
+
+
+# One simulated client, writes go straight to the stream and a reader task records the delivery latency of every marker it sees
+class LoadClient:
+    def __init__(self, index, framed, runId, stats):
+        self.index = index
+        self.nickname = f"lg{runId}{index}" # Unique per run, the sessions of the last run can still hold their nicknames
+        self.framed = framed
+        self.runId = runId
+        self.stats = stats
+        self.writer = None
+        self.readerTask = None
+
+    async def connect(self, host, port, channel):
+        reader, self.writer = await asyncio.open_connection(host, port)
+        self.send(f"NICKNAME:{self.nickname}")
+        welcome = await reader.read(4096) # Welcome, session token and the general channel history
+        if b"Welcome" not in welcome:
+            raise ConnectionError(f"{self.nickname} was not accepted: {welcome[:100]!r}")
+        if channel != "general":
+            self.send(f"JOIN:{channel}")
+        self.readerTask = asyncio.create_task(self.readLoop(reader))
+
+    def send(self, text):
+        data = text.encode("utf-8")
+        if self.framed:
+            data = FRAME_HEADER.pack(len(data)) + data
+        self.writer.write(data)
+
+    async def readLoop(self, reader):
+        buffer = b""
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                now = time.perf_counter_ns()
+                buffer += data
+                end = 0
+                for match in MARKER.finditer(buffer): # Markers are found the same way with and without framing
+                    end = match.end()
+                    if match.group(1).decode() != self.runId or int(match.group(2)) == self.index:
+                        continue # History from an earlier run or the echo of our own message
+                    self.stats.record(now - int(match.group(3)))
+                self.stats.errors += data.count(b"ERROR:")
+                buffer = buffer[end:] if end else buffer[-64:] # Keep what could be the start of a marker
+        except (ConnectionError, OSError):
+            pass
+        self.stats.disconnects += 1
+
+    def close(self):
+        if self.readerTask:
+            self.readerTask.cancel()
+        if self.writer:
+            self.writer.close()
+
+
+# Counters shared by every client of a run, measuring starts once the warmup is over
+class RunStats:
+    def __init__(self):
+        self.latencies = [] # Delivery latency in ns, one per received copy of a message
+        self.sent = 0
+        self.errors = 0
+        self.disconnects = 0
+        self.measuring = False
+
+    def record(self, latency):
+        if self.measuring:
+            self.latencies.append(latency)
+
+
+# Helper function for reading the CPU seconds and memory of a process and its children from /proc (Linux only)
+def processUsage(pid):
+    cpu = 0.0
+    rss = 0
+    pids = [pid]
+    while pids:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK") # utime and stime
+            with open(f"/proc/{current}/statm") as file:
+                rss += int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            with open(f"/proc/{current}/task/{current}/children") as file:
+                pids += [int(child) for child in file.read().split()] # Worker processes
+        except (OSError, IndexError, ValueError):
+            continue
+    return cpu, rss
+
+
+# Helper function for picking the channel of every client, zipf puts most clients in the first channels like a real chat
+def channelFor(index, channelCount, distribution, rng):
+    if channelCount <= 1:
+        return "general"
+    if distribution == "zipf":
+        weights = [1 / (rank + 1) for rank in range(channelCount)]
+        channel = rng.choices(range(channelCount), weights)[0]
+    else:
+        channel = index % channelCount
+    return "general" if channel == 0 else f"bench{channel}"
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Function for running one load test against a server that is already listening
+async def runLoad(args, pid=None):
+    rng = random.Random(args.seed)
+    runId = f"{random.getrandbits(24):06x}"
+    stats = RunStats()
+    clients = [LoadClient(i, args.framed, runId, stats) for i in range(args.clients)]
+    limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(client):
+        async with limit:
+            await client.connect(args.host, args.port, channelFor(client.index, args.channels, args.distribution, rng))
+
+    await asyncio.gather(*(connect(client) for client in clients))
+    await asyncio.sleep(0.5) # Let the JOIN replies arrive before the clock starts
+
+    interval = 1 / args.rate
+    total = args.warmup + args.duration
+    start = time.perf_counter()
+    nextSend = start
+    cpuStart = rssPeak = 0
+    nextSample = start
+    while True:
+        now = time.perf_counter()
+        if not stats.measuring and now - start >= args.warmup:
+            stats.measuring = True
+            stats.sent = 0
+            measureStart = now
+            cpuStart = processUsage(pid)[0] if pid else 0
+        if now - start >= total:
+            break
+        if pid and now >= nextSample:
+            rssPeak = max(rssPeak, processUsage(pid)[1])
+            nextSample = now + SAMPLE_INTERVAL
+        while nextSend <= now: # Open loop, the schedule doesn't wait for the server so slow replies show up as latency
+            sender = rng.choice(clients)
+            marker = f"@lg{runId}-{sender.index}-{int(nextSend * 1e9)}@" # Scheduled time, not the actual send, so a stalled loop is counted too
+            if args.clients > 1 and rng.random() < args.dm_ratio:
+                receiver = rng.choice(clients)
+                while receiver is sender:
+                    receiver = rng.choice(clients)
+                sender.send(f"DM:{receiver.nickname}:{marker}{args.padding}")
+            else:
+                sender.send(f"MSG:{marker}{args.padding}")
+            stats.sent += 1
+            nextSend += interval
+        await asyncio.sleep(min(interval, 0.005))
+    measureTime = time.perf_counter() - measureStart
+    sent = stats.sent
+    cpuUsed = processUsage(pid)[0] - cpuStart if pid else None
+    await asyncio.sleep(args.drain) # Messages still on the way are counted, new ones aren't sent
+    stats.measuring = False
+    for client in clients:
+        client.close()
+
+    latencies = sorted(stats.latencies)
+    return {
+        "clients": args.clients,
+        "channels": args.channels,
+        "rate": args.rate,
+        "sentPerSecond": sent / measureTime,
+        "deliveredPerSecond": len(latencies) / measureTime,
+        "p50Ms": percentile(latencies, 0.50) / 1e6,
+        "p99Ms": percentile(latencies, 0.99) / 1e6,
+        "p999Ms": percentile(latencies, 0.999) / 1e6,
+        "maxMs": (latencies[-1] / 1e6) if latencies else 0.0,
+        "serverCpuPercent": cpuUsed / measureTime * 100 if cpuUsed is not None else None,
+        "serverRssMb": rssPeak / 1e6 if pid else None,
+        "errors": stats.errors,
+        "disconnects": stats.disconnects, # Connections the server closed during the run
+    }
+
+
+# Function for starting a server with the given engine and waiting until it accepts connections
+def startServer(args, engine):
+    command = [sys.executable, SERVER, "--engine", engine, "--port", str(args.port), "--queue-size", str(args.queue_size),
+               "--max-connections-per-ip", "0", # Every simulated client comes from the same address
+               "--rate-limit", "MSG=0", "--rate-limit", "DM=0", "--flood-strikes", "0"] # The offered load is set with --rate, not by the server's limits
+    if args.framed:
+        command.append("--framed")
+    if args.workers > 1:
+        command += ["--workers", str(args.workers)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise SystemExit(f"Server with engine {engine} did not start")
+
+
+def stopServer(process):
+    process.send_signal(2) # Ctrl+C, the server stops its workers itself
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def printResult(name, result):
+    cpu = f"{result['serverCpuPercent']:6.1f}%" if result["serverCpuPercent"] is not None else "   n/a"
+    rss = f"{result['serverRssMb']:7.1f} MB" if result["serverRssMb"] is not None else "    n/a"
+    print(f"{name:<10} sent {result['sentPerSecond']:8.0f}/s delivered {result['deliveredPerSecond']:9.0f}/s "
+          f"p50 {result['p50Ms']:7.2f} ms p99 {result['p99Ms']:7.2f} ms p999 {result['p999Ms']:7.2f} ms "
+          f"cpu {cpu} rss {rss} errors {result['errors']} disconnects {result['disconnects']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load generator for the chat server, reports delivery latency, throughput, server CPU and memory")
+    parser.add_argument("--engine", nargs="+", choices=["threaded", "asyncio", "selectors"], help="Start a server with each engine in turn and compare them")
+    parser.add_argument("--pid", type=int, help="Process id of an already running server to measure CPU and memory of, without --engine")
+    parser.add_argument("--host", default="127.0.0.1", help="Server address")
+    parser.add_argument("--port", type=int, default=3100, help="Server port")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for the servers started with --engine")
+    parser.add_argument("--queue-size", type=int, default=256, help="Outbound queue size for the servers started with --engine")
+    parser.add_argument("--framed", action="store_true", help="Use the framed protocol, the server must use it too")
+    parser.add_argument("--clients", type=int, default=100, help="Simulated clients")
+    parser.add_argument("--channels", type=int, default=1, help="Channels the clients are spread over")
+    parser.add_argument("--distribution", choices=["uniform", "zipf"], default="uniform", help="How the clients are spread over the channels")
+    parser.add_argument("--rate", type=float, default=200, help="Messages sent per second by all clients together")
+    parser.add_argument("--dm-ratio", type=float, default=0.1, help="Share of the messages sent as DMs")
+    parser.add_argument("--size", type=int, default=64, help="Length of the message text")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds measured")
+    parser.add_argument("--warmup", type=float, default=2, help="Seconds of load before measuring")
+    parser.add_argument("--drain", type=float, default=1, help="Seconds to wait for late deliveries after sending stops")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the channels and senders")
+    parser.add_argument("--json", help="Write the results to this file, for comparing runs")
+    args = parser.parse_args()
+    args.padding = "x" * max(args.size - 40, 0) # The marker takes about 40 characters
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard)) # One descriptor per simulated client
+
+    results = {}
+    if args.engine:
+        for engine in args.engine:
+            process = startServer(args, engine)
+            try:
+                results[engine] = asyncio.run(runLoad(args, process.pid))
+            finally:
+                stopServer(process)
+            printResult(engine, results[engine])
+    else:
+        results["server"] = asyncio.run(runLoad(args, args.pid))
+        printResult("server", results["server"])
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
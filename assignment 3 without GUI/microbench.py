@@ -0,0 +1,208 @@
+import argparse
+import itertools
+import json
+import sys
+import time
+from datetime import datetime
+
+import server # server.py in the same folder, only starts listening when run directly
+
+ROUNDS = 5 # Every loop is timed this many times and the fastest round counts, the slower ones were disturbed by something else
+
+
+# Stand-in for ClientSocket that only counts what would be sent, so the numbers are server CPU only
+class FakeSocket:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.closed = False
+        self.nickname = None
+        self.lastActivity = time.time()
+        self.buckets = {}
+
+    def send(self, data):
+        self.sendFrame(server.frameMessage(data))
+        return len(data)
+
+    def sendFrame(self, frame):
+        self.frames += 1
+        self.bytes += len(frame)
+
+    def close(self):
+        pass
+
+
+# Function for filling the server state with channels of fake members and history, members are per channel
+# Channel 0 is "general" like on a real server, the others are bench1, bench2, ...
+def setupChannels(channelCount, members, historyDepth=0):
+    server.RATE_LIMITS = {} # The benchmarks send the same command back to back
+    server.clients.clear()
+    server.nicknameIndex.clear()
+    server.channels.clear()
+    server.userChannels.clear()
+    server.messageHistory.clear()
+    for c in range(channelCount):
+        channel = channelName(c)
+        for i in range(members):
+            addFakeClient(f"user{c}_{i}", channel)
+        history = server.getHistory(channel)
+        for i in range(historyDepth):
+            history.append(server.HistoryEntry(f"user{c}_0", "x" * 64, "12.00"))
+
+
+def channelName(index):
+    return "general" if index == 0 else f"bench{index}"
+
+
+def addFakeClient(nickname, channel):
+    clientSocket = FakeSocket()
+    clientSocket.nickname = nickname
+    server.clients[nickname] = {'socket': clientSocket}
+    server.nicknameIndex[nickname.casefold()] = nickname
+    server.addToChannel(nickname, channel, clientSocket)
+    return clientSocket
+
+
+# Helper function for timing a loop body, returns the CPU time of one call in ns
+def timeCalls(function, calls):
+    best = None
+    for _ in range(ROUNDS):
+        start = time.process_time()
+        for _ in range(calls):
+            function()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / calls * 1e9
+
+
+# Helper function for timing the kind of work every command does (timestamp, formatting, encoding, dict lookups)
+# Baselines from a faster or slower machine are scaled by it
+def calibrate():
+    names = {f"user{i}": i for i in range(100)}
+    return timeCalls(lambda: [f"MSG:{datetime.now().strftime('%H.%M')}:user{i}:{names[f'user{i}']}".encode("utf-8") for i in range(10)], 1000)
+
+
+def result(benchmark, channels, members, history, nsPerOp, **extra):
+    return dict(benchmark=benchmark, channels=channels, members=members, history=history, nsPerOp=nsPerOp, **extra)
+
+
+# Benchmark for the CPU cost of broadcasting one chat message as the channel grows
+def benchBroadcast(channels, members, history, calls):
+    setupChannels(channels, members, history)
+    senderSocket = server.clients["user0_0"]['socket']
+    message = "x" * 64 # Typical short chat line
+    nsPerOp = timeCalls(lambda: server.broadcast(message, "general", "user0_0", senderSocket), calls)
+    return result("broadcast", channels, members, history, nsPerOp, nsPerRecipient=nsPerOp / max(members - 1, 1))
+
+
+# Benchmark for looking up the channel of a client, done for every MSG
+def benchGetUsersChannel(channels, members, history, calls):
+    setupChannels(channels, members, history)
+    nickname = f"user{channels - 1}_{members - 1}" # Last client added, worst case for a scan
+    return result("getUsersChannel", channels, members, history, timeCalls(lambda: server.getUsersChannel(nickname), calls))
+
+
+# Benchmark for removing a client when it disconnects, the clients are added before the timing starts
+def benchDeleteUserdata(channels, members, history, calls):
+    setupChannels(channels, members, history)
+    channel = channelName(channels - 1)
+    spares = [f"spare{i}" for i in range(calls)]
+    best = None
+    for _ in range(ROUNDS):
+        for nickname in spares:
+            addFakeClient(nickname, channel)
+        start = time.process_time()
+        for nickname in spares:
+            server.deleteUserdata(nickname)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return result("deleteUserdata", channels, members, history, best / calls * 1e9)
+
+
+# Benchmark for sending a DM, includes the case insensitive lookup of the receiver
+def benchPrivateMessage(channels, members, history, calls):
+    setupChannels(channels, members, history)
+    senderSocket = server.clients["user0_0"]['socket']
+    receiver = f"USER{channels - 1}_{members - 1}" # Different case so the index is used
+    return result("privatemessage", channels, members, history, timeCalls(lambda: server.privatemessage("x" * 64, "user0_0", receiver, senderSocket), calls))
+
+
+# Benchmark for JOIN, moves a client back and forth between two channels, each join replays the latest history
+def benchJoin(channels, members, history, calls):
+    setupChannels(max(channels, 2), members, history)
+    nickname = "user0_0"
+    clientSocket = server.clients[nickname]['socket']
+    targets = itertools.cycle([channelName(1), channelName(0)])
+    nsPerOp = timeCalls(lambda: server.handleCommand(f"JOIN:{next(targets)}", nickname, clientSocket), calls)
+    return result("join", channels, members, history, nsPerOp)
+
+
+BENCHMARKS = {
+    "broadcast": benchBroadcast,
+    "getUsersChannel": benchGetUsersChannel,
+    "deleteUserdata": benchDeleteUserdata,
+    "privatemessage": benchPrivateMessage,
+    "join": benchJoin,
+}
+
+
+# Function for running every selected benchmark with every combination of the parameters
+def runBenchmarks(names, channelCounts, memberCounts, historyDepths, calls):
+    results = []
+    for name in names:
+        for channels, members, history in itertools.product(channelCounts, memberCounts, historyDepths):
+            if name == "broadcast" or name == "join" or history == historyDepths[0]: # Only these two read the history
+                results.append(BENCHMARKS[name](channels, members, history, calls))
+    return results
+
+
+def resultKey(result):
+    return f"{result['benchmark']} channels={result['channels']} members={result['members']} history={result['history']}"
+
+
+def printResults(results):
+    for result in results:
+        line = f"{resultKey(result):<60} {result['nsPerOp']:12.0f} ns/op"
+        if "nsPerRecipient" in result:
+            line += f" {result['nsPerRecipient']:8.0f} ns/recipient"
+        print(line)
+
+
+# Function for comparing against a saved baseline, returns the results that got slower than the tolerance allows
+def compareBaseline(results, calibration, baseline, tolerance):
+    scale = calibration / baseline["calibrationNs"] # Above 1 when this run is on a slower machine
+    old = {resultKey(result): result["nsPerOp"] * scale for result in baseline["results"]}
+    slower = []
+    for result in results:
+        key = resultKey(result)
+        if key in old and result["nsPerOp"] > old[key] * tolerance:
+            slower.append((key, old[key], result["nsPerOp"]))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-process benchmarks for the chat server")
+    parser.add_argument("--bench", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS), help="Benchmarks to run")
+    parser.add_argument("--channels", type=int, nargs="+", default=[1, 10, 100], help="Channel counts to test")
+    parser.add_argument("--members", type=int, nargs="+", default=[10, 100, 1000], help="Members per channel to test")
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 1000], help="History depths per channel to test")
+    parser.add_argument("--messages", type=int, default=500, help="Calls timed per combination")
+    parser.add_argument("--framed", action="store_true", help="Benchmark with the framed protocol")
+    parser.add_argument("--save-baseline", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare with a JSON file written by --save-baseline, exits with 1 if something got slower")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="How many times slower than the baseline counts as a regression")
+    args = parser.parse_args()
+    server.FRAMED = args.framed
+    calibration = calibrate()
+    results = runBenchmarks(args.bench, args.channels, args.members, args.history, args.messages)
+    printResults(results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({"framed": args.framed, "python": sys.version.split()[0], "calibrationNs": calibration, "results": results}, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            slower = compareBaseline(results, calibration, json.load(file), args.tolerance)
+        for key, before, after in slower:
+            print(f"Slower than the baseline: {key} {before:.0f} -> {after:.0f} ns/op")
+        if slower:
+            sys.exit(1)
@@ -1,13 +1,57 @@
+import argparse
+import asyncio
+import atexit
+import base64
+import bisect
+import hashlib
+import hmac
+import http.server
+import json
+import mmap
+import os
+import queue
+import secrets
+import selectors
+import signal
 import socket
+import struct
+import sys
 import threading
 import time
+from collections import deque
 from contextlib import contextmanager
 from datetime import datetime
+from itertools import islice
+from urllib.parse import quote
 
 # Server configuration values change as needed
 HOST = '0.0.0.0' # Bind to all interfaces
 PORT = 3000
 SERVERADDRESS = (HOST, PORT) # Server address and port
+ENGINE = "threaded" # Server engine, "threaded" for thread per client, "asyncio" for coroutine per client or "selectors" for one event loop thread
+LISTEN_BACKLOG = 1024 # Connections the kernel keeps waiting for accept, more than that are refused until the server catches up
+WORKERS = 1 # Worker processes sharing the port with SO_REUSEPORT, with more than 1 they are connected by a message bus
+NODE_ID = None # Name of this server among linked servers, hostname:port when not set
+PEER_PORT = None # Port other servers link to, None means this server only opens links itself
+PEER_HOST = '127.0.0.1' # Interface the peer port listens on, only this machine by default since linked servers are trusted with everything
+PEER_SECRET = None # Shared secret every linked server sends in its hello, links with another secret are closed
+MAX_LINE = 16 * 1024 * 1024 # Longest bus or peer message, a full history page of the largest messages fits, longer ones close the connection
+PEER_RETRY_INTERVAL = 2 # Seconds between attempts to reach a peer that is down
+HANDOFF_PATH = None # Unix socket where the server waits for a replacement process, the replacement takes over its connections (selectors engine)
+HANDOFF_TIMEOUT = 10 # Seconds to wait for the other process during a hot restart
+HANDOFF_BATCH = 200 # File descriptors sent in one message, the kernel limits how many fit
+RING_REPLICAS = 64 # Points per node on the channel ownership ring, more points spread the channels more evenly
+
+# Message framing
+FRAMED = False # Prefix every message with its length so TCP can't glue messages together or cut them off
+FRAME_HEADER = struct.Struct("!I") # 4 byte big endian message length
+MAX_FRAME_SIZE = 64 * 1024 # Largest message accepted from a client in framed mode
+RECV_SIZE = 4096 # Number of bytes to read from a socket at once
+
+# Outbound queues, every client has its own queue and writer so broadcast never waits on a slow socket
+OUTBOUND_QUEUE_SIZE = 256 # Messages waiting for one client before it counts as a slow consumer
+SLOW_CLIENT_POLICY = "disconnect" # What to do when the queue is full: "drop_oldest", "disconnect" or "coalesce"
+MAX_COALESCED_BYTES = 1024 * 1024 # The coalesce policy disconnects the client once its pending data grows over this
 # Function to get local IP address
 def get_local_ip():
     try:
@@ -24,358 +68,2505 @@ def get_local_ip():
 
 # Values for checking client connection
 clientTimeout = 120 # Timeout in seconds
-clientsCheckInterval = 30 # Interval in seconds to check for client connection
+clientsCheckInterval = 1 # Tick of the idle timer in seconds, a tick only looks at the clients that are due
+
+# Hashed timer wheel for idle timeouts, connections are put in the bucket of the tick their deadline falls in
+# Activity only updates a timestamp on the connection, the wheel checks it when the bucket comes due and reschedules if needed
+class TimerWheel:
+    def __init__(self, tick):
+        self.tick = tick
+        self.buckets = {} # Tick number to the set of connections due in that tick
+        self.currentTick = int(time.time() // tick) # Last tick that has been expired
+        self.lock = threading.Lock()
+
+    def schedule(self, item, deadline):
+        with self.lock:
+            tickNumber = max(int(deadline // self.tick), self.currentTick + 1) # Never in a tick that already passed
+            self.buckets.setdefault(tickNumber, set()).add(item)
+
+    def expire(self, now): # Take out everything due up to now, cost is the number of due items not the number of clients
+        due = []
+        with self.lock:
+            nowTick = int(now // self.tick)
+            for tickNumber in range(self.currentTick + 1, nowTick + 1):
+                due.extend(self.buckets.pop(tickNumber, ()))
+            self.currentTick = max(self.currentTick, nowTick)
+        return due
+
+idleTimers = TimerWheel(clientsCheckInterval)
 
 # message history
-messageHistory = {} # Store message history for each channel
-MAX_HISTORY = 20 # Maximum number of messages to store
+messageHistory = {} # Store message history for each channel, channel name to MessageHistory
+MAX_HISTORY = 1000 # Maximum number of messages to keep in memory per channel
+JOIN_HISTORY = 20 # Latest messages sent on JOIN, older ones are fetched with the HISTORY command
+MAX_HISTORY_PAGE = 200 # Most messages returned by one HISTORY command
 
-# Context manager for acquiring locks
-@contextmanager
-def acquirelocks(): # Acquire both locks
-    with clientsLock:
+# One stored channel message, __slots__ keeps long histories small
+class HistoryEntry:
+    __slots__ = ("sender", "message", "time", "id")
+
+    def __init__(self, sender, message, time, id=None):
+        self.sender = sender
+        self.message = message
+        self.time = time
+        self.id = id # Sequence number within the channel, set when the entry is added to the history
+
+# Fixed size ring buffer of the latest messages in a channel, the oldest message is dropped when it is full
+class MessageHistory:
+    def __init__(self, capacity):
+        self.entries = deque(maxlen=capacity) # deque with maxlen is a ring buffer, append is O(1) and never copies
+        self.lock = threading.Lock() # Appends and snapshots can come from different threads
+        self.nextId = 1 # Sequence number for the next message
+
+    def append(self, entry):
+        with self.lock:
+            if entry.id is None: # New message, entries restored from the history log already have one
+                entry.id = self.nextId
+            self.nextId = entry.id + 1
+            self.entries.append(entry)
+
+    def page(self, beforeId=None, limit=None): # Up to limit newest entries with an id below beforeId, oldest first
+        with self.lock:
+            end = len(self.entries)
+            if beforeId is not None: # Ids only grow but can have gaps, for example where a damaged record was skipped on reload
+                end = bisect.bisect_left(self.entries, beforeId, key=lambda entry: entry.id)
+            start = 0 if limit is None else max(0, end - limit)
+            skip = len(self.entries) - end # Newer entries after the page
+            if start <= skip: # islice walks a deque from one end, start from the closer one
+                return list(islice(self.entries, start, end))
+            page = list(islice(reversed(self.entries), skip, skip + end - start))
+            page.reverse()
+            return page
+
+    def __len__(self):
+        return len(self.entries)
+
+# Logging, records go through a queue to a writer thread so no thread waits for the terminal, least of all while holding a lock
+LOG_FORMAT = "text" # "text" writes the plain lines, "json" one structured record per line
+LOG_LEVEL = "info" # Lowest level written: debug, info, warning or error
+LOG_ERROR_RATE = 20 # Warning and error records of one event written per second, the rest are counted and reported as suppressed
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+logWriter = None # LogWriter once started, before that log() prints directly
+
+# Background writer for log records, formats them and writes everything that queued up in one go
+class LogWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.queue = queue.SimpleQueue() # Record dicts, None stops the writer
+        self.errorWindows = {} # Event to [second, written, suppressed] for rate limiting error records
+        self.lock = threading.Lock() # Lock for errorWindows, only taken for error records
+        self.thread = threading.Thread(target=self.writeLoop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def allowError(self, event, now): # Returns False if too many errors of this event were written this second
+        second = int(now)
+        with self.lock:
+            window = self.errorWindows.get(event)
+            if window is None or window[0] != second:
+                if window and window[2]: # Report what the last window dropped
+                    self.queue.put({"time": now, "level": "warning", "event": event, "message": f"Suppressed {window[2]} more '{event}' errors", "suppressed": window[2]})
+                window = self.errorWindows[event] = [second, 0, 0]
+            if window[1] >= LOG_ERROR_RATE:
+                window[2] += 1
+                return False
+            window[1] += 1
+            return True
+
+    def suppressedReports(self, now, everything=False): # Records for the windows that are over, or for all of them when the writer stops
+        second = int(now)
+        reports = []
+        with self.lock:
+            for event, window in list(self.errorWindows.items()):
+                if window[0] != second or everything:
+                    if window[2]:
+                        reports.append({"time": now, "level": "warning", "event": event, "message": f"Suppressed {window[2]} more '{event}' errors", "suppressed": window[2]})
+                    del self.errorWindows[event]
+        return reports
+
+    def writeLoop(self):
+        running = True
+        while running:
+            try: # Wakes up every second while there are error windows, so suppressed counts are reported even if the errors stop
+                records = [self.queue.get(timeout=1 if self.errorWindows else None)]
+            except queue.Empty:
+                records = []
+            try:
+                while True: # Everything that queued up meanwhile goes out in one write
+                    records.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            if None in records:
+                running = False
+            records += self.suppressedReports(time.time(), not running)
+            lines = [formatRecord(record) for record in records if record is not None]
+            if not lines:
+                continue
+            try:
+                self.stream.write("".join(lines))
+                self.stream.flush()
+            except (OSError, ValueError): # Terminal is gone, keep draining so nobody blocks
+                pass
+
+    def close(self): # Writes what is queued and stops the writer
+        self.queue.put(None)
+        self.thread.join(5)
+
+# Helper function for turning a record into one output line
+def formatRecord(record):
+    if LOG_FORMAT != "json":
+        return record["message"] + "\n"
+    record = dict(record, time=datetime.fromtimestamp(record["time"]).isoformat(timespec="milliseconds"))
+    if WORKERS > 1:
+        record["worker"] = workerId
+    return json.dumps(record, default=str) + "\n"
+
+# Function for logging an event, only puts the record in the queue so it is safe to call while holding locks
+def log(level, event, message, **fields):
+    if LOG_LEVELS[level] < LOG_LEVELS[LOG_LEVEL]:
+        return
+    now = time.time()
+    if logWriter is None:
+        print(message)
+        return
+    if LOG_LEVELS[level] >= LOG_LEVELS["warning"] and not logWriter.allowError(event, now): # A reconnect loop can't flood the log either
+        return
+    logWriter.queue.put({"time": now, "level": level, "event": event, "message": message, **fields})
+
+# Function for starting the log writer, again in every worker since the writer thread doesn't survive fork
+def startLogging():
+    global logWriter
+    logWriter = LogWriter(sys.stdout)
+    atexit.register(stopLogging)
+
+def stopLogging():
+    if logWriter:
+        logWriter.close()
+
+# Persistent history on disk, off unless the server is started with --history-dir
+HISTORY_DIR = None # Folder for the history log, one subfolder of segment files per channel
+HISTORY_SEGMENT_SIZE = 64 * 1024 * 1024 # Start a new segment file once the current one is this big
+HISTORY_FSYNC_INTERVAL = 1.0 # Seconds between fsyncs, messages written in the last interval can be lost on a crash
+historyLog = None # HistoryLog when persistent history is enabled
+
+# Append only log of channel messages split into segment files
+# broadcast only puts the entry in a queue, a writer thread batches the writes and fsyncs on an interval
+class HistoryLog:
+    def __init__(self, directory, segmentSize=HISTORY_SEGMENT_SIZE, fsyncInterval=HISTORY_FSYNC_INTERVAL):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.fsyncInterval = fsyncInterval
+        self.queue = queue.SimpleQueue() # (channel, HistoryEntry) waiting to be written
+        self.files = {} # Open segment file for each channel, only used by the writer thread
+        self.closed = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self.writerThread = threading.Thread(target=self.writeLoop)
+        self.writerThread.daemon = True
+        self.writerThread.start()
+
+    def append(self, channel, entry): # Never touches the disk, safe to call while holding locks
+        self.queue.put((channel, entry))
+
+    def channelDirectory(self, channel):
+        return os.path.join(self.directory, quote(channel, safe="")) # Channel names can contain any character
+
+    def segments(self, channel): # Segment file paths of a channel, oldest first
+        directory = self.channelDirectory(channel)
+        if not os.path.isdir(directory):
+            return []
+        return [os.path.join(directory, name) for name in sorted(os.listdir(directory)) if name.endswith(".log")]
+
+    def openSegment(self, channel, firstId, rotate=False): # Segments are named after the id of their first message
+        segments = self.segments(channel)
+        if segments and not rotate and os.path.getsize(segments[-1]) < self.segmentSize:
+            path = segments[-1] # Continue the newest segment
+        else:
+            os.makedirs(self.channelDirectory(channel), exist_ok=True)
+            path = os.path.join(self.channelDirectory(channel), f"{firstId:016d}.log")
+        self.files[channel] = open(path, "ab")
+        return self.files[channel]
+
+    def writeLoop(self):
+        lastSync = time.monotonic()
+        dirty = set() # Files written since the last fsync
+        while not (self.closed.is_set() and self.queue.empty()):
+            try:
+                batch = [self.queue.get(timeout=self.fsyncInterval)]
+            except queue.Empty:
+                batch = []
+            while True: # Take everything that is waiting so it goes to disk in one write per channel
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = {}
+            for channel, entry in batch:
+                record = json.dumps({"id": entry.id, "time": entry.time, "sender": entry.sender, "message": entry.message}) + "\n" # One record per line, json escapes newlines
+                records.setdefault(channel, []).append((entry.id, record.encode("utf-8")))
+            for channel, lines in records.items():
+                try:
+                    logFile = self.files.get(channel) or self.openSegment(channel, lines[0][0])
+                    size = logFile.tell()
+                    chunk = [] # Records for the current segment, written in one go
+                    for entryId, line in lines:
+                        if size and size + len(line) > self.segmentSize: # Rotate to a new segment, a record bigger than a segment gets one of its own
+                            logFile.write(b"".join(chunk))
+                            logFile.flush()
+                            os.fsync(logFile.fileno()) # Closed segments are complete on disk
+                            logFile.close()
+                            dirty.discard(logFile)
+                            logFile = self.openSegment(channel, entryId, True)
+                            size = 0
+                            chunk = []
+                        chunk.append(line)
+                        size += len(line)
+                    logFile.write(b"".join(chunk))
+                    logFile.flush()
+                    dirty.add(logFile)
+                except OSError as e:
+                    log("error", "history_error", f"Error writing history for {channel}: {e}", channel=channel, error=str(e))
+            if dirty and (time.monotonic() - lastSync >= self.fsyncInterval or self.closed.is_set()):
+                for logFile in dirty:
+                    try:
+                        os.fsync(logFile.fileno())
+                    except (OSError, ValueError):
+                        pass
+                dirty.clear()
+                lastSync = time.monotonic()
+        for logFile in self.files.values():
+            logFile.close()
+
+    def readBefore(self, channel, beforeId, count): # Up to count newest entries with an id below beforeId, oldest first, read through mmap
+        entries = []
+        for path in reversed(self.segments(channel)):
+            if len(entries) >= count:
+                break
+            if beforeId is not None and int(os.path.basename(path)[:-4]) >= beforeId: # Segment only has newer messages
+                continue
+            with open(path, "rb") as logFile:
+                if os.fstat(logFile.fileno()).st_size == 0:
+                    continue
+                with mmap.mmap(logFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    end = data.rfind(b"\n") + 1 # Ignore a record the writer is still in the middle of
+                    segmentEntries = []
+                    while end > 0 and len(entries) + len(segmentEntries) < count: # Walk the records backwards from the end
+                        start = data.rfind(b"\n", 0, end - 1) + 1
+                        line = data[start:end]
+                        end = start
+                        try:
+                            record = json.loads(line)
+                            entry = HistoryEntry(record["sender"], record["message"], record["time"], record["id"])
+                        except (ValueError, KeyError, TypeError): # Damaged record, for example from a disk that filled up, the rest of the log is still fine
+                            continue
+                        if beforeId is not None and entry.id >= beforeId:
+                            continue
+                        segmentEntries.append(entry)
+                    entries = segmentEntries[::-1] + entries
+        return entries
+
+    def readTail(self, channel, count): # Latest count entries of a channel, oldest first
+        return self.readBefore(channel, None, count)
+
+    def close(self): # Write and fsync everything still queued
+        self.closed.set()
+        self.writerThread.join()
+
+# Function for adding the length prefix to an outgoing message when framing is enabled
+def frameMessage(data):
+    if FRAMED:
+        return FRAME_HEADER.pack(len(data)) + data
+    return data
+
+# Reassembly buffer for messages received from a client
+class FrameBuffer:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data): # Add received bytes and return the complete messages
+        if not FRAMED:
+            return [data.decode("utf-8")] # Unframed protocol treats one read as one message
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer)
+            if length > MAX_FRAME_SIZE: # Don't buffer forever for a broken or hostile client
+                raise ValueError(f"Frame of {length} bytes is too large")
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end: # Rest of the message has not arrived yet
+                break
+            messages.append(self.buffer[FRAME_HEADER.size:end].decode("utf-8"))
+            del self.buffer[:end]
+        return messages
+
+# Function for making room in a full outbound queue according to SLOW_CLIENT_POLICY, returns False if the client should be disconnected
+def makeRoom(queue):
+    if SLOW_CLIENT_POLICY == "drop_oldest": # Client misses the oldest messages but stays connected
+        queue.popleft()
+        return True
+    if SLOW_CLIENT_POLICY == "coalesce": # Merge everything pending into one write, meant for the framed protocol
+        merged = b"".join(queue)
+        if len(merged) > MAX_COALESCED_BYTES:
+            return False
+        queue.clear()
+        queue.append(merged)
+        return True
+    return False # disconnect
+
+# Metrics, off unless the server is started with --metrics-port
+METRICS_PORT = None # Local HTTP port serving Prometheus style metrics at /metrics, worker n uses METRICS_PORT + n
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0) # Histogram buckets in seconds
+metrics = None # Metrics when enabled, every hook checks it first so the cost is one global lookup when off
+
+# Counter that only goes up, the lock keeps increments from different threads from getting lost
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+# Histogram with fixed buckets like Prometheus, counts[i] is the number of observations in bucket i, the last one is +Inf
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.record(value)
+
+    def record(self, value): # Caller makes sure no one else records at the same time
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels=""): # Text format lines, bucket counts are cumulative
+        separator = "," if labels else ""
+        lines = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + ["+Inf"], self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {total}')
+        labels = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{labels} {self.sum}")
+        lines.append(f"{name}_count{labels} {total}")
+        return lines
+
+# Lock that records how long threads wait for it, replaces clientsLock and channelsLock when metrics are on
+# Waits are recorded after the lock is taken, so the lock itself keeps the numbers consistent
+class TimedLock:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquires = 0
+        self.contended = 0 # Acquires that had to wait
+        self.waits = Histogram() # Wait time of the contended acquires
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False): # Free, nothing to measure
+            self.acquires += 1
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        if not self.lock.acquire(True, timeout):
+            return False
+        self.acquires += 1
+        self.contended += 1
+        self.waits.record(time.perf_counter() - start)
+        return True
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+# Registry of everything the metrics endpoint reports, gauges are read from the server state when scraped
+class Metrics:
+    def __init__(self):
+        self.messagesIn = Counter() # Commands received from clients
+        self.messagesOut = Counter() # Messages queued for clients
+        self.bytesSent = Counter() # Bytes written to client sockets
+        self.sendErrors = Counter() # Failed sends, including clients dropped for being too slow
+        self.fanout = Histogram() # Time to hand one channel message to every member
+        self.rejected = Counter() # Connections turned away by admission control
+
+    def render(self):
         with channelsLock:
-            yield
+            members = {channel: len(channelMembers) for channel, channelMembers in channels.items()}
+        with clientsLock:
+            parked = len(sessions)
+            connected = len(clients) - parked
+        lines = [
+            "# TYPE chat_connected_clients gauge", f"chat_connected_clients {connected}",
+            "# TYPE chat_parked_sessions gauge", f"chat_parked_sessions {parked}",
+            "# TYPE chat_open_connections gauge", f"chat_open_connections {openConnections}",
+            "# TYPE chat_channel_members gauge",
+        ]
+        lines += [f'chat_channel_members{{channel="{metricLabel(channel)}"}} {count}' for channel, count in members.items()]
+        for name, counter in (("chat_messages_received_total", self.messagesIn), ("chat_messages_sent_total", self.messagesOut),
+                              ("chat_bytes_sent_total", self.bytesSent), ("chat_send_errors_total", self.sendErrors),
+                              ("chat_connections_rejected_total", self.rejected)):
+            lines += [f"# TYPE {name} counter", f"{name} {counter.value}"]
+        lines.append("# TYPE chat_broadcast_fanout_seconds histogram")
+        lines += self.fanout.lines("chat_broadcast_fanout_seconds")
+        lines += ["# TYPE chat_lock_acquires_total counter", "# TYPE chat_lock_contended_total counter", "# TYPE chat_lock_wait_seconds histogram"]
+        for name, lock in (("clientsLock", clientsLock), ("channelsLock", channelsLock)):
+            lines.append(f'chat_lock_acquires_total{{lock="{name}"}} {lock.acquires}')
+            lines.append(f'chat_lock_contended_total{{lock="{name}"}} {lock.contended}')
+            lines += lock.waits.lines("chat_lock_wait_seconds", f'lock="{name}"')
+        return "\n".join(lines) + "\n"
+
+# Helper function for escaping a channel name for a metric label
+def metricLabel(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+# HTTP handler for the metrics endpoint
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # No line for every scrape
+
+# Function for turning on the metrics and serving them on localhost, the locks are swapped before any thread uses them
+def startMetrics(port):
+    global metrics, clientsLock, channelsLock
+    metrics = Metrics()
+    clientsLock = TimedLock()
+    channelsLock = TimedLock()
+    httpServer = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    thread = threading.Thread(target=httpServer.serve_forever)
+    thread.daemon = True
+    thread.start()
+    if workerId == 0:
+        log("info", "metrics", f"Metrics on http://127.0.0.1:{port}/metrics", port=port)
+
+# Lock contention profiler, off unless the server is started with --lock-profile, the report is printed on SIGUSR1
+LOCK_PROFILE = False # Record wait and hold times of clientsLock, channelsLock and the channel locks per call site
+PROFILED_COMMANDS = {"JOIN", "MSG", "DM", "LIST", "HISTORY", "QUIT"} # Commands that get their own call site, anything else counts as "unknown command"
+lockSite = threading.local() # Call site of the current thread, set by the functions wrapped in startLockProfiler
+
+# Wait and hold times of one lock from one call site
+class LockSiteStats:
+    __slots__ = ("acquires", "waitTotal", "waitMax", "holdTotal", "holdMax")
+
+    def __init__(self):
+        self.acquires = 0
+        self.waitTotal = self.waitMax = 0.0
+        self.holdTotal = self.holdMax = 0.0
+
+# TimedLock that also keeps wait and hold times per call site, the numbers are updated while the lock is held
+class ProfiledLock(TimedLock):
+    def __init__(self, name):
+        super().__init__()
+        self.name = name
+        self.sites = {} # Call site to LockSiteStats
+        self.holder = None # LockSiteStats of the current holder
+        self.acquiredAt = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        if not TimedLock.acquire(self, blocking, timeout):
+            return False
+        self.acquiredAt = time.perf_counter()
+        site = getattr(lockSite, "name", "other")
+        stats = self.sites.get(site)
+        if stats is None:
+            stats = self.sites[site] = LockSiteStats()
+        wait = self.acquiredAt - start
+        stats.acquires += 1
+        stats.waitTotal += wait
+        stats.waitMax = max(stats.waitMax, wait)
+        self.holder = stats
+        return True
+
+    def release(self):
+        held = time.perf_counter() - self.acquiredAt
+        stats = self.holder
+        stats.holdTotal += held
+        stats.holdMax = max(stats.holdMax, held)
+        self.lock.release()
+
+    __enter__ = acquire
+
+# Helper function for wrapping a function so the locks it takes are counted for the given call site
+def withLockSite(function, site):
+    def wrapper(*args):
+        previous = getattr(lockSite, "name", "other")
+        lockSite.name = site(*args) if callable(site) else site
+        try:
+            return function(*args)
+        finally:
+            lockSite.name = previous
+    return wrapper
+
+def commandSite(msg, *args):
+    command = msg.split(":", 1)[0]
+    return command if command in PROFILED_COMMANDS else "unknown command"
+
+# Function for turning on the profiler, swaps the locks and wraps the entry points before any thread uses them
+def startLockProfiler():
+    global clientsLock, channelsLock, ChannelLock, handleCommand, registerNickname, joinDefaultChannel, disconnectInactiveClients, dropClient, cleanupClient, handleBusMessage
+    clientsLock = ProfiledLock("clientsLock")
+    channelsLock = ProfiledLock("channelsLock")
+    ChannelLock = lambda: ProfiledLock("channel locks") # Channel locks are reported together, there can be many
+    for name in channelLocks:
+        channelLocks[name] = ChannelLock()
+    handleCommand = withLockSite(handleCommand, commandSite)
+    registerNickname = withLockSite(registerNickname, "login")
+    joinDefaultChannel = withLockSite(joinDefaultChannel, "login")
+    disconnectInactiveClients = withLockSite(disconnectInactiveClients, "timeout checker")
+    dropClient = withLockSite(dropClient, "disconnect")
+    cleanupClient = withLockSite(cleanupClient, "disconnect")
+    handleBusMessage = withLockSite(handleBusMessage, "bus")
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=printLockReport).start()) # Not in the handler, it could interrupt a print
+
+# Function for printing the call sites ranked by the total time threads waited there, reads the numbers without locking
+# Goes to stderr in one write, so it stays out of the log output on stdout and the reports of several workers don't mix
+def printLockReport():
+    rows = {}
+    locks = [clientsLock, channelsLock] + list(channelLocks.values())
+    for lock in locks:
+        for site, stats in dict(lock.sites).items(): # Copy, other threads can add call sites meanwhile
+            row = rows.setdefault((lock.name, site), LockSiteStats())
+            row.acquires += stats.acquires
+            row.waitTotal += stats.waitTotal
+            row.waitMax = max(row.waitMax, stats.waitMax)
+            row.holdTotal += stats.holdTotal
+            row.holdMax = max(row.holdMax, stats.holdMax)
+    lines = [f"Lock contention report{f' of worker {workerId}' if WORKERS > 1 else ''}, ranked by total wait"]
+    lines.append(f"{'lock':<14} {'call site':<16} {'acquires':>10} {'wait ms':>10} {'avg wait us':>12} {'max wait ms':>12} {'hold ms':>10} {'avg hold us':>12} {'max hold ms':>12}")
+    for (name, site), row in sorted(rows.items(), key=lambda item: item[1].waitTotal, reverse=True):
+        count = max(row.acquires, 1)
+        lines.append(f"{name:<14} {site:<16} {row.acquires:>10} {row.waitTotal * 1e3:>10.1f} {row.waitTotal / count * 1e6:>12.1f} {row.waitMax * 1e3:>12.2f} "
+                     f"{row.holdTotal * 1e3:>10.1f} {row.holdTotal / count * 1e6:>12.1f} {row.holdMax * 1e3:>12.2f}")
+    print("\n".join(lines), file=sys.stderr, flush=True)
+
+# Flood protection, token buckets per connection for each command and per channel for MSG
+RATE_LIMITS = {"MSG": (20, 40), "DM": (20, 40), "JOIN": (2, 10), "LIST": (2, 10)} # Command to (tokens per second, burst), a rate of 0 turns the limit off
+CHANNEL_RATE = (0, 0) # (messages per second, burst) for each channel, shared by its members, 0 turns it off
+FLOOD_STRIKES = 20 # Rejected commands within FLOOD_WINDOW seconds before the client is disconnected, 0 never disconnects
+FLOOD_WINDOW = 10
+channelBuckets = {} # Channel name to its TokenBucket, used while holding the channel's lock
+
+# Token bucket, refilled by rate tokens per second up to burst, one token per command
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst # Starts full so a new client can send a burst right away
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+# Function for checking a command against the client's limit, returns False if it has to be rejected
+# The buckets live on the client socket, only the thread or loop handling that client uses them
+def allowCommand(command, clientSocket):
+    rate, burst = RATE_LIMITS.get(command, (0, 0))
+    if not rate:
+        return True
+    bucket = clientSocket.buckets.get(command)
+    if bucket is None:
+        bucket = clientSocket.buckets[command] = TokenBucket(rate, burst)
+    return bucket.take()
+
+# Function for checking the limit of a channel, caller holds the channel's lock
+def allowChannelMessage(channel):
+    rate, burst = CHANNEL_RATE
+    if not rate:
+        return True
+    bucket = channelBuckets.get(channel)
+    if bucket is None:
+        bucket = channelBuckets[channel] = TokenBucket(rate, burst)
+    return bucket.take()
+
+# Function for counting a rejected command, returns True if the client has been rejected too often and should be disconnected
+def floodStrike(clientSocket):
+    if not FLOOD_STRIKES:
+        return False
+    strikes = clientSocket.buckets.get("strikes")
+    if strikes is None:
+        strikes = clientSocket.buckets["strikes"] = TokenBucket(FLOOD_STRIKES / FLOOD_WINDOW, FLOOD_STRIKES)
+    return not strikes.take()
+
+# Helper function for parsing a limit given as rate/burst on the command line
+def parseRate(text):
+    rate, _, burst = text.partition("/")
+    rate = float(rate)
+    return rate, float(burst) if burst else rate * 2 # Burst defaults to two seconds worth
+
+# Admission control, connections over the limits get an ERROR and are closed right after accept, before a thread or task is spent on them
+FD_HEADROOM = 64 # File descriptors kept free for the listener, the log and history files, the bus and the peers
+
+# Helper function for the default connection cap, every client needs a file descriptor so the cap stays under the process limit
+def defaultMaxConnections():
+    try:
+        import resource
+    except ImportError: # Not on Windows
+        return 10000
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return 10000
+    return max(soft - FD_HEADROOM, 1)
+
+MAX_CONNECTIONS = defaultMaxConnections() # Open connections at once, 0 for no limit
+MAX_CONNECTIONS_PER_IP = 100 # Open connections from one address, 0 for no limit
+openConnections = 0
+connectionsPerIp = {} # Address to its number of open connections
+admissionLock = threading.Lock() # Lock for openConnections and connectionsPerIp
+
+# Function for counting a new connection, returns None if it is admitted or the reason it is rejected
+# force counts it anyway, for connections taken over from an old process
+def admitConnection(address, force=False):
+    global openConnections
+    ip = address[0] if address else None
+    with admissionLock:
+        if not force and MAX_CONNECTIONS and openConnections >= MAX_CONNECTIONS:
+            return "Server is full, try again later"
+        if not force and MAX_CONNECTIONS_PER_IP and connectionsPerIp.get(ip, 0) >= MAX_CONNECTIONS_PER_IP:
+            return "Too many connections from your address"
+        openConnections += 1
+        connectionsPerIp[ip] = connectionsPerIp.get(ip, 0) + 1
+    return None
+
+# Function for uncounting a connection when it is closed
+def releaseConnection(address):
+    global openConnections
+    ip = address[0] if address else None
+    with admissionLock:
+        openConnections -= 1
+        if connectionsPerIp.get(ip, 0) > 1:
+            connectionsPerIp[ip] -= 1
+        else:
+            connectionsPerIp.pop(ip, None)
+
+# Function for turning a connection away, one non blocking send of a small frame always fits in a fresh socket's buffer
+def rejectConnection(sock, address, reason):
+    try:
+        sock.setblocking(False)
+        sock.send(rejectionFrame(address, reason))
+    except OSError:
+        pass
+    sock.close()
+
+# Helper function for logging a rejected connection, returns the ERROR frame to send it
+def rejectionFrame(address, reason):
+    log("warning", "rejected", f"Rejected connection from {address}: {reason}", address=address, reason=reason)
+    if metrics:
+        metrics.rejected.inc()
+    timestamp = datetime.now().strftime("%H.%M")
+    return frameMessage(f"ERROR:{timestamp}:{reason}".encode("utf-8"))
 
 # Store clients using their nicknames
 clients = {} # To store nickname, client sockets and last activity time
+nicknameIndex = {} # Case insensitive lookup, casefolded nickname to the nickname used in clients
 clientsLock = threading.Lock() # Lock for clients to be safe for concurrent access
  
+# Session resume, a client whose connection dropped can come back with its token and continue where it left off
+RESUME_GRACE = 60 # Seconds a dropped client's nickname and channel are kept for it, 0 turns resuming off
+sessions = {} # Resume token to the ParkedSession of a dropped client, guarded by clientsLock
+stopping = False # Set when the server shuts down, the sessions would be lost with the process anyway
+ 
 # Store channels and their clients
-channels = {"general": set()} # Store channels and their clients
-channelsLock = threading.Lock() # Lock for channels to be safe for concurrent access
+channels = {"general": {}} # Store channels and their clients, channel name to {nickname: client socket}
+userChannels = {} # Reverse index of channels, nickname to the channel the client is in, kept in sync with channels
+channelsLock = threading.Lock() # Lock for the channels directory and userChannels, held only for quick lookups
+ChannelLock = threading.Lock # Type of the channel locks, ProfiledLock when profiling
+channelLocks = {"general": ChannelLock()} # One lock per channel, guards its members and history so channels don't wait for each other
+# Lock order to avoid deadlocks: channel locks sorted by name, then channelsLock, then clientsLock, then remoteLock
+
+# Clients connected to other worker processes or other nodes, learned from the bus
+workerId = 0 # Index of this worker process
+bus = None # WorkerBus when running with more than one worker, PeerBus when linked to other nodes
+remoteUsers = {} # Casefolded nickname to {"nickname", "channel", "origin", "since"}, origin is the worker or node the client is on
+remoteLock = threading.Lock() # Lock for remoteUsers
+BUS_RECV_SIZE = 64 * 1024 # Bytes read from the worker bus at once
+
+# Helper function for getting the lock of a channel, created on first use, caller holds channelsLock
+def channelLock(name):
+    lock = channelLocks.get(name)
+    if lock is None:
+        lock = channelLocks[name] = ChannelLock()
+    return lock
+
+# Context manager for locking one or more channels, always in name order so two JOINs can't deadlock
+@contextmanager
+def lockChannels(*names):
+    with channelsLock:
+        locks = [channelLock(name) for name in sorted(set(names) - {None})]
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+# Context manager for locking the channel a client is in and any extra channels, gives the client's channel
+@contextmanager
+def lockUsersChannel(nickname, *extraChannels):
+    while True:
+        channel = getUsersChannel(nickname)
+        with lockChannels(channel, *extraChannels):
+            if getUsersChannel(nickname) == channel: # Client wasn't moved or removed while waiting for the lock
+                yield channel
+                return
+
+# Function for printing how clients can connect to the server
+def printServerInfo():
+    if workerId > 0: # Workers share the port so only the first one prints
+        return
+    local_ip = get_local_ip() # Get local IP address for clients to connect in the network
+    log("info", "start", "Server is starting...")
+    log("info", "start", f"Server started and listening on all interfaces (0.0.0.0:{PORT})", port=PORT, engine=ENGINE)
+    log("info", "start", f"For clients to connect on your network, use this address: {local_ip}:{PORT}") #Display the local IP address
+    log("info", "start", f"For local connections, use: 127.0.0.1:{PORT}") # Display the local loopback address
+    log("info", "start", "Press Ctrl+C to stop the server")
+
+# Function for notifying all clients that the server is shutting down
+def notifyShutdown():
+    global stopping
+    stopping = True # Connections closing from now on are not parked for a resume
+    clientSockets = [client['socket'] for client in list(clients.values()) if not isinstance(client['socket'], ParkedSession)]
+    for clientSocket in clientSockets: # Notify all clients that the server is shutting down
+        try:
+            timestamp = datetime.now().strftime("%H.%M") # Get the current time
+            clientSocket.send(f"ERROR:{timestamp}:Server is shutting down".encode("utf-8")) # Notify the client
+            clientSocket.close() # Close the socket once the queued messages are sent
+        except:
+            pass # Ignore errors while closing sockets
+    return clientSockets
 
 # Function for starting server
 def startServer():
     # Create a socket
     serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP socket
     serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Reuse the socket
+    if WORKERS > 1:
+        serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Every worker listens on the same port, the kernel spreads the connections
     serverSocket.bind(SERVERADDRESS) # Bind to the address
-    serverSocket.listen() # Listen for connections
+    serverSocket.listen(LISTEN_BACKLOG) # Listen for connections
     serverSocket.settimeout(1) # Set a timeout for the socket to avoid blocking
-    local_ip = get_local_ip() # Get local IP address for clients to connect in the network
-    print("Server is starting...")
-    print(f"Server started and listening on all interfaces (0.0.0.0:{PORT})")
-    print(f"For clients to connect on your network, use this address: {local_ip}:{PORT}") #Display the local IP address
-    print(f"For local connections, use: 127.0.0.1:{PORT}") # Display the local loopback address
-    print("Press Ctrl+C to stop the server")
+    printServerInfo()
     # Start the client connection checker thread
     connectionCheckerThread = threading.Thread(target=checkClientConnection) 
     connectionCheckerThread.daemon = True # Daemonize the thread
     connectionCheckerThread.start() # Start the thread
+    if bus:
+        bus.start(handleBusMessage) # Messages from the other workers are handled on the bus reader thread
     
     try:
         while True:
             try:
                 # Wait for a connection
                 clientSocket, clientAddress = serverSocket.accept()
-                print(f"Connection from {clientAddress}")
+                reason = admitConnection(clientAddress)
+                if reason: # Turned away on the accept thread, no client thread is started
+                    rejectConnection(clientSocket, clientAddress, reason)
+                    continue
+                log("info", "connect", f"Connection from {clientAddress}", address=clientAddress)
                 clientThread = threading.Thread(target=handleClient, args=(clientSocket, clientAddress)) # Create a new thread for the client
                 clientThread.daemon = True # Daemonize the thread
-                clientThread.start()
+                try:
+                    clientThread.start()
+                except RuntimeError as e: # Out of threads, the client is turned away instead of stopping the server
+                    releaseConnection(clientAddress)
+                    rejectConnection(clientSocket, clientAddress, "Server is full, try again later")
+                    log("error", "thread_error", f"Could not start a client thread: {e}", error=str(e))
             except socket.timeout:
                 #To allow KeyboardInterrupt to be caught
                 # without blocking the server
                 continue
+            except OSError as e: # For example out of file descriptors, wait a moment so the loop doesn't spin
+                log("error", "accept_error", f"Error accepting connection: {e}", error=str(e))
+                time.sleep(0.1)
     except KeyboardInterrupt:
-        for client in clients.values(): # Notify all clients that the server is shutting down
-            try:
-                timestamp = datetime.now().strftime("%H.%M") # Get the current time
-                client['socket'].send(f"ERROR:{timestamp}:Server is shutting down".encode("utf-8")) # Notify the client
-                client['socket'].close() # Close the socket
-            except:
-                pass # Ignore errors while closing sockets
+        for clientSocket in notifyShutdown():
+            clientSocket.waitClosed(1) # Give the writers a moment to send the shutdown message
+        if historyLog:
+            historyLog.close() # Make sure the latest messages are on disk
         serverSocket.close() # Close the server socket
-        print("Server stopped") # Print server stopped message
+        log("info", "stop", "Server stopped")
+
+# Function for starting the asyncio server, one coroutine per client instead of one thread
+def startAsyncServer():
+    printServerInfo()
+    try:
+        asyncio.run(runAsyncServer())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass # Clients are notified when the server coroutine is cancelled
+    if historyLog:
+        historyLog.close() # Make sure the latest messages are on disk
+    log("info", "stop", "Server stopped")
+
+asyncHandlers = set() # Tasks of the open connections in the asyncio engine, cancelled when the server stops
+
+async def runAsyncServer():
+    server = await asyncio.start_server(handleAsyncClient, HOST, PORT, reuse_address=True, reuse_port=WORKERS > 1, backlog=LISTEN_BACKLOG)
+    connectionChecker = asyncio.create_task(checkClientConnectionAsync()) # Same inactivity check as the threaded engine
+    if bus: # Messages from the other workers are handed to the event loop so client sockets are only used from one thread
+        loop = asyncio.get_running_loop()
+        bus.start(lambda message: loop.call_soon_threadsafe(handleBusMessage, message))
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel) # Replaces stopWorker, runs the same cleanup as Ctrl+C
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        connectionChecker.cancel()
+        writerTasks = [clientSocket.writerTask for clientSocket in notifyShutdown()]
+        if writerTasks:
+            await asyncio.wait(writerTasks, timeout=1) # Give the writers a moment to send the shutdown message
+        handlers = list(asyncHandlers) # Also the connections still logging in, they aren't in clients
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
 
 # Helper functions for getting clients channel
-def getUsersChannel(nickname, lockalreadyused=False):
-    if not lockalreadyused: # Acquire the locks if not already held
+def getUsersChannel(nickname):
+    with channelsLock:
+        return userChannels.get(nickname) # Return the channel if the user is in one
+
+# Helper functions for moving a client to a channel, caller holds the locks of the old and the new channel
+def addToChannel(nickname, channel, clientSocket):
+    with channelsLock:
+        removeFromChannel(nickname, True) # A client is only in one channel at a time
+        if channel not in channels: # Create the channel if it doesn't exist
+            channels[channel] = {}
+        channels[channel][nickname] = clientSocket
+        userChannels[nickname] = channel
+        if bus:
+            bus.publish(type="channel", nickname=nickname, channel=channel)
+
+# Helper function for removing a client from its channel, caller holds the lock of the client's channel
+def removeFromChannel(nickname, lockalreadyused=False):
+    if not lockalreadyused:
         with channelsLock:
-            for channel, users in channels.items():
-                if nickname in users: 
-                    return channel # Return the channel if the user is in it
-    else:
-        # If lock is already held, don't try to acquire it again
-        for channel, users in channels.items():
-            if nickname in users:
-                return channel
-    return None
-# Helper functions for deleting userdata
+            return removeFromChannel(nickname, True)
+    channel = userChannels.pop(nickname, None)
+    if channel is not None:
+        channels[channel].pop(nickname, None)
+    return channel
+
+# Helper functions for finding a connected client case insensitively, returns the nickname used in clients or None
+def findClient(nickname): # Caller holds clientsLock
+    return nicknameIndex.get(nickname.casefold())
+
+# Helper function for removing a client and its index entry, caller holds clientsLock
+def removeClient(nickname):
+    if clients.pop(nickname, None) is not None:
+        nicknameIndex.pop(nickname.casefold(), None)
+        if bus:
+            bus.publish(type="offline", nickname=nickname)
+
+# Helper function for checking that a nickname still belongs to the given connection
+def ownsNickname(nickname, clientSocket):
+    with clientsLock:
+        return nickname in clients and clients[nickname]['socket'] is clientSocket
+
+# Helper functions for deleting userdata, locks_held means the caller holds the lock of the client's channel
 def deleteUserdata(nickname, locks_held=False):
-    # Use acquirelocks for consistency instead of separate locks
     if not locks_held:
-        with acquirelocks():
-            # Remove from all channels
-            for channel in channels.values():
-                if nickname in channel:
-                    channel.discard(nickname)
-            
-            # Remove from clients dictionary
-            if nickname in clients:
-                clients.pop(nickname, None)
-    else:
-        # Locks already held
-        for channel in channels.values():
-            if nickname in channel:
-                channel.discard(nickname)
-                
-        if nickname in clients: # Remove from clients dictionary
-            clients.pop(nickname, None)
+        with lockUsersChannel(nickname):
+            deleteUserdata(nickname, True)
+        return
+    removeFromChannel(nickname) # Remove from the channel
+    with clientsLock:
+        removeClient(nickname) # Remove from clients dictionary
 
 # Helper function to handle client disconnect and other errors
 def disconnectClient(nickname, locks_held=False):
     deleteUserdata(nickname, locks_held) # Delete user data
-    print(f"{nickname} disconnected")
+    log("info", "disconnect", f"{nickname} disconnected", nickname=nickname)
 
 def checkClientConnection():
     while True:
-        time.sleep(clientsCheckInterval)  # Check every 30 seconds
-        currentTime = time.time()  # Get the current time
-        clientsToDisconnect = [] # List of clients to disconnect
+        time.sleep(clientsCheckInterval)  # Check every tick
+        disconnectInactiveClients()
+
+# Asyncio version of checkClientConnection, runs on the event loop so sockets are only touched from one thread
+async def checkClientConnectionAsync():
+    while True:
+        await asyncio.sleep(clientsCheckInterval)
+        disconnectInactiveClients()
+
+# Helper function for disconnecting clients that have been inactive for too long
+def disconnectInactiveClients():
+    currentTime = time.time()  # Get the current time
+    for clientSocket in idleTimers.expire(currentTime): # Only the clients whose deadline came up, no locks held
+        if clientSocket.closed: # Already gone, nothing to do
+            continue
+        if isinstance(clientSocket, ParkedSession): # Grace period of a dropped client is over
+            expireSession(clientSocket)
+            continue
+        deadline = clientSocket.lastActivity + clientTimeout
+        if deadline > currentTime: # Active since it was scheduled, check again at the new deadline
+            idleTimers.schedule(clientSocket, deadline)
+            continue
         
-        with acquirelocks(): 
-            for nickname, client_data in list(clients.items()): # Iterate over a copy of the dictionary
-                if currentTime - client_data['lastActivity'] > clientTimeout: # Check if the client has timed out
-                    print(f"Client {nickname} timed out after {clientTimeout} seconds of inactivity") 
-                    clientsToDisconnect.append(nickname)
+        # Disconnect inactive client
+        nickname = clientSocket.nickname
+        with lockUsersChannel(nickname) as currentChannel:
+            if not ownsNickname(nickname, clientSocket): # Left on its own in the meantime
+                continue
+            log("info", "timeout", f"Client {nickname} timed out after {clientTimeout} seconds of inactivity", nickname=nickname)
+            if currentChannel:
+                broadcast(f"{nickname} has been disconnected due to inactivity", 
+                          currentChannel, None, None, True)
+            try: # Try to send a message to the client about the disconnection
+                timestamp = datetime.now().strftime("%H.%M") 
+                clientSocket.send(f"ERROR:{timestamp}:Disconnected due to inactivity".encode("utf-8"))
+            except:
+                pass
+            clientSocket.close() # Closed once the ERROR is sent, the reader then ends and the connection is released
             
-            # Disconnect inactive clients
-            for nickname in clientsToDisconnect: 
-                currentChannel = getUsersChannel(nickname, True)
-                if currentChannel:
-                    broadcast(f"{nickname} has been disconnected due to inactivity", 
-                              currentChannel, None, None, True)
-                try: # Try to send a message to the client about the disconnection
-                    timestamp = datetime.now().strftime("%H.%M") 
-                    clients[nickname]['socket'].send(f"ERROR:{timestamp}:Disconnected due to inactivity".encode("utf-8"))
-                    #clients[nickname]['socket'].close() # Close the socket reduntant since we are already disconnecting the client
-                except:
-                    pass
-                
-                disconnectClient(nickname, True) # Disconnect the client and remove from clients dictionary
+            disconnectClient(nickname, True) # Disconnect the client and remove from clients dictionary
+
+# Helper function for getting the message history of a channel, creates it if it doesn't exist
+def getHistory(channel):
+    with channelsLock:
+        history = messageHistory.get(channel)
+    if history is None:
+        history = MessageHistory(MAX_HISTORY)
+        if historyLog: # Pick up where the log left off, for example after a restart, outside the lock since it reads the disk
+            for entry in historyLog.readTail(channel, MAX_HISTORY):
+                history.append(entry)
+        with channelsLock:
+            history = messageHistory.setdefault(channel, history) # Another thread may have created it meanwhile
+    return history
+
+# Helper function for getting a page of a channel's history, from memory and from the history log when it goes further back
+def getHistoryPage(channel, beforeId, limit):
+    with channelsLock:
+        history = messageHistory.get(channel)
+    entries = history.page(beforeId, limit) if history else []
+    if len(entries) < limit and historyLog:
+        olderThan = entries[0].id if entries else beforeId
+        entries = historyLog.readBefore(channel, olderThan, limit - len(entries)) + entries
+    return entries
+
+# Helper function for sending an already framed message to everyone in a channel except the sender, caller holds the channel's lock
+def sendToChannel(payload, channel, sender=None):
+    members = channels.get(channel)
+    if not members:
+        return
+    for nickname, memberSocket in list(members.items()): # Iterate over a copy since unreachable clients are removed
+        if nickname != sender: # Don't send the message to the sender
+            try:
+                memberSocket.sendFrame(payload)
+            except Exception as e:
+                log("error", "send_error", f"Error sending to {nickname}: {e}", nickname=nickname, error=str(e)) # Only queued, we hold the channel lock
+                if metrics:
+                    metrics.sendErrors.inc()
+                deleteUserdata(nickname, True) # Remove the client if it can't be reached, its channel is the one we hold
+
+# Function for storing a channel message and sending it to the channel's members on this worker or node, caller holds the channel's lock
+# store is False on nodes that don't own the channel, only the owner keeps its history
+def deliverToChannel(message, channel, sender, timestamp, store=True):
+    if store:
+        entry = HistoryEntry(sender, message, timestamp)
+        getHistory(channel).append(entry) # Store the message in the history, oldest is dropped when full
+        if historyLog:
+            historyLog.append(channel, entry) # Written to disk by the log's own thread
+    payload = frameMessage(f"MSG:{timestamp}:{message}".encode("utf-8")) # Encoded and framed once, the same bytes go to every member
+    if metrics:
+        start = time.perf_counter()
+        sendToChannel(payload, channel, sender)
+        metrics.fanout.observe(time.perf_counter() - start)
+    else:
+        sendToChannel(payload, channel, sender)
+
+# Helper functions for finding the node that owns a channel's history, None when channels are not split between nodes
+def channelOwner(channel):
+    return bus.ownerOf(channel) if bus else None
+
+def ownsChannel(channel):
+    owner = channelOwner(channel)
+    return owner is None or owner == bus.origin
 
-# Function for broadcasting messages to all clients in a channel
+# Function for passing a channel message from its owner to the other nodes that have members in the channel, caller holds the channel's lock
+def relayToMemberNodes(channel, sender, message, timestamp, skip=None):
+    with remoteLock:
+        nodes = {user["origin"] for user in remoteUsers.values() if user["channel"] == channel}
+    for node in nodes - {skip}: # skip already delivered it to its own members
+        bus.publish(type="deliver", to=node, channel=channel, sender=sender, message=message, time=timestamp)
+
+# Function for broadcasting messages to all clients in a channel, locks_held means the caller holds the channel's lock
 def broadcast(message, channel, sender=None, clientSocket=None, locks_held=False): # Broadcast a message to all clients in a channel, Different messages depending on the sender
-    timestamp = datetime.now().strftime("%H.%M")
-    if channel not in messageHistory: # Create a new message history for the channel if it doesn't exist for channel
-        messageHistory[channel] = []
-        
-    messageEntry = {"sender": sender, "message": message, "time": timestamp} # Create a message entry
-    messageHistory[channel].append(messageEntry) # Store the message in the history
-    
-    if len(messageHistory[channel]) > MAX_HISTORY: # Limit the number of messages stored
-        messageHistory[channel] = messageHistory[channel][-MAX_HISTORY:]
     if not locks_held:
-        with acquirelocks():
-            if channel in channels:
-                for nickname in channels[channel]: # Iterate over all clients in the channel
-                    if nickname != sender and nickname in clients: # Don't send the message to the sender
-                        try:
-                            clients[nickname]['socket'].send(f"MSG:{timestamp}:{message}".encode("utf-8")) 
-                        except Exception as e:
-                            print(f"Error sending to {nickname}: {e}")
-                            # Direct modification since we're holding the locks
-                            for ch in channels.values(): # Remove the client from all channels if they can't be reached
-                                if nickname in ch:
-                                    ch.discard(nickname)
-                            if nickname in clients:  # Remove the client from the clients dictionary
-                                clients.pop(nickname, None)
-    else:
-        # Locks already held by caller
-        if channel in channels:
-            for nickname in channels[channel]:
-                if nickname != sender and nickname in clients:
-                    try:
-                        clients[nickname]['socket'].send(f"MSG:{timestamp}:{message}".encode("utf-8"))
-                    except Exception as e:
-                        print(f"Error sending to {nickname}: {e}")
-                        # Direct modification since we're holding the locks
-                        for ch in channels.values(): # Remove the client from all channels if they can't be reached
-                            if nickname in ch:
-                                ch.discard(nickname)
-                        if nickname in clients: # Remove the client from the clients dictionary
-                            clients.pop(nickname, None)
+        with lockChannels(channel):
+            broadcast(message, channel, sender, clientSocket, True)
+        return
+    timestamp = datetime.now().strftime("%H.%M")
+    owner = channelOwner(channel)
+    deliverToChannel(message, channel, sender, timestamp, owner is None or owner == bus.origin)
+    if owner is None:
+        if bus: # Members on the other workers get it from their own worker
+            bus.publish(type="broadcast", channel=channel, sender=sender, message=message, time=timestamp)
+    elif owner == bus.origin:
+        relayToMemberNodes(channel, sender, message, timestamp)
+    else: # The owner stores it and passes it on to the nodes with members
+        bus.publish(type="broadcast", to=owner, channel=channel, sender=sender, message=message, time=timestamp)
     
-    # Confirm to sender their message was sent (outside the lock)
+    # Confirm to sender their message was sent
     if sender and clientSocket:
         try:
             clientSocket.send(f"MSG_SENT:{timestamp}:{message}".encode("utf-8")) # Confirm to sender their message was sent
         except Exception as e:
-            print(f"Error confirming to {sender}: {e}") #debugging line
+            log("error", "send_error", f"Error confirming to {sender}: {e}", nickname=sender, error=str(e))
+            if metrics:
+                metrics.sendErrors.inc()
 
 # Function for sending private messages
 def privatemessage(message, sender, receiver, clientSocket):
     timestamp = datetime.now().strftime("%H.%M")
     with clientsLock:
-        actual_receiver = None # Actual receiver nickname
-        for nick in clients:
-            if nick.lower() == receiver.lower(): # Check if the receiver exists using case insensitive comparison
-                actual_receiver = nick 
-                break
-                
+        actual_receiver = findClient(receiver) # Actual receiver nickname, case insensitive
         if actual_receiver:
             try:
                 clients[actual_receiver]['socket'].send(f"PRIVATE:{timestamp}:{sender}:{message}".encode("utf-8")) # Send the private message
                 clientSocket.send(f"PRIVATE_SENT:{timestamp}:{actual_receiver}:{message}".encode("utf-8"))
                 # Update last activity for receiver
-                clients[actual_receiver]['lastActivity'] = time.time()
+                clients[actual_receiver]['socket'].lastActivity = time.time()
                 return True
             except Exception as e:
-                print(f"Error sending DM: {e}")
+                log("error", "send_error", f"Error sending DM: {e}", error=str(e))
+                if metrics:
+                    metrics.sendErrors.inc()
                 timestamp = datetime.now().strftime("%H.%M")
                 clientSocket.send(f"ERROR:{timestamp}:Failed to send message to {actual_receiver}".encode("utf-8")) # Notify sender of failure
+            return False
+    remoteUser = findRemoteUser(receiver) # Not on this worker, maybe on another one
+    if remoteUser:
+        bus.publish(type="dm", to=remoteUser["origin"], sender=sender, receiver=remoteUser["nickname"], message=message, time=timestamp)
+        clientSocket.send(f"PRIVATE_SENT:{timestamp}:{remoteUser['nickname']}:{message}".encode("utf-8"))
+        return True
+    clientSocket.send(f"ERROR:{timestamp}:User {receiver} not found".encode("utf-8")) # Notify sender that the user was not found
+    return False
+
+# Function for sending a history snapshot to a client, the whole replay goes out as one write
+# Has a HISTORY_MORE:<channel>:<id> line before the footer when older messages exist, the client can pass the id to the HISTORY command
+def sendHistory(clientSocket, nickname, entries, channel):
+    timestamp = datetime.now().strftime("%H.%M")
+    lines = [f"INFO:{timestamp}:--- Begin History ---\n"] # Header to mark the beginning of history
+    for entry in entries:
+        if entry.sender == nickname:
+            sendername = "You"
+        else:
+            sendername = entry.sender
+        lines.append(f"HISTORY:{entry.time}:{sendername}:{entry.message}\n")
+    if entries and entries[0].id > 1: # Ids start from 1 so there is something older
+        lines.append(f"HISTORY_MORE:{channel}:{entries[0].id}\n") # Own line so it can be found without framing too
+    lines.append(f"INFO:{timestamp}:--- End History ---\n") # Footer to mark the end of history
+    clientSocket.sendFrame(b"".join(frameMessage(line.encode("utf-8")) for line in lines)) # Each line is still its own frame
+
+# Function for answering JOIN or HISTORY with a page of history, JOIN sends nothing when the only message is its own join message
+def replyHistory(clientSocket, nickname, entries, channel, join):
+    if len(entries) > 1 or (entries and not join):
+        sendHistory(clientSocket, nickname, entries, channel)
+    elif not join:
+        timestamp = datetime.now().strftime("%H.%M")
+        clientSocket.send(f"INFO:{timestamp}:No older messages in {channel}".encode("utf-8"))
+
+# Function for registering the nickname sent by a new client, returns the nickname if it was accepted
+def registerNickname(msg, clientSocket):
+    if msg.startswith("RESUME:") and RESUME_GRACE: # Reconnect of a client that dropped
+        return resumeSession(msg.split("RESUME:",1)[1].strip(), clientSocket)
+    if not msg.startswith("NICKNAME:"):
+        return None
+    requestNickname = msg.split("NICKNAME:",1)[1].strip()
+    
+    # Basic nickname validation
+    if len(requestNickname) < 2 or len(requestNickname) > 20: # Check if the nickname is between 2-20 characters
+        timestamp = datetime.now().strftime("%H.%M")
+        clientSocket.send(f"ERROR:{timestamp}:Nickname must be between 2-20 characters".encode("utf-8"))
+        return None
+    
+    with clientsLock:  # Check if nickname is already taken
+        if findClient(requestNickname) or findRemoteUser(requestNickname): # Notify client that the nickname is already taken
+            timestamp = datetime.now().strftime("%H.%M")
+            clientSocket.send(f"ERROR:{timestamp}:Nickname already taken".encode("utf-8"))
+            return None
+        # Add client to clients dictionary
+        clients[requestNickname] = {
+            'socket': clientSocket, 
+            'since': time.time(), # Decides who keeps the nickname if another worker took it at the same time
+            'token': secrets.token_urlsafe(16), # Lets the client resume the session if its connection drops
+        }
+        nicknameIndex[requestNickname.casefold()] = requestNickname
+        if bus:
+            bus.publish(type="online", nickname=requestNickname, since=clients[requestNickname]['since'])
+        clientSocket.nickname = requestNickname
+        clientSocket.lastActivity = time.time()
+        idleTimers.schedule(clientSocket, clientSocket.lastActivity + clientTimeout) # Start the idle timeout
+        timestamp = datetime.now().strftime("%H.%M")
+        clientSocket.send(f"INFO:{timestamp}:Welcome {requestNickname}".encode("utf-8"))
+        if RESUME_GRACE:
+            clientSocket.send(f"SESSION:{clients[requestNickname]['token']}".encode("utf-8"))
+        log("info", "login", f"{requestNickname} connected", nickname=requestNickname)
+    return requestNickname
+
+# Function for adding a newly registered client to the default channel
+def joinDefaultChannel(nickname, clientSocket, defaultChannel="general"):
+    with lockChannels(defaultChannel):
+        if not ownsNickname(nickname, clientSocket): # Dropped already, for example because it was too slow
+            return
+        if getUsersChannel(nickname): # Resumed session, already back in its old channel
+            return
+        addToChannel(nickname, defaultChannel, clientSocket)
+        broadcast(f"{nickname} has joined the {defaultChannel}", defaultChannel, None, None, True) # Notify other channel members doesn't need to send back msg_sent since it is not a message
+
+# Function for handling one command from a registered client, returns True if the client quit
+def handleCommand(msg, nickname, clientSocket):
+    # Update last activity time whenever a message is received, a plain attribute write so no lock is needed
+    clientSocket.lastActivity = time.time()
+    if metrics:
+        metrics.messagesIn.inc()
+    command = msg.split(":",1)[0]
+    if command in RATE_LIMITS and not allowCommand(command, clientSocket): # Over the limit, the command is dropped
+        timestamp = datetime.now().strftime("%H.%M")
+        if floodStrike(clientSocket):
+            log("warning", "flood", f"{nickname} disconnected for flooding", nickname=nickname)
+            clientSocket.send(f"ERROR:{timestamp}:Disconnected for sending too many commands".encode("utf-8"))
+            cleanupClient(nickname, clientSocket)
+            clientSocket.close()
+            return True
+        clientSocket.send(f"ERROR:{timestamp}:Slow down, too many {command} commands".encode("utf-8"))
+        return False
+    # Handle different message types
+    if msg.startswith("JOIN:"): # Join a channel
+        requestChannel = msg.split("JOIN:",1)[1].strip()
+        with lockUsersChannel(nickname, requestChannel) as currentChannel: # Locks only the channel being left and the one being joined
+            if not ownsNickname(nickname, clientSocket): # Dropped by another thread, for example because it was too slow
+                return False
+            if currentChannel and currentChannel != requestChannel: # Check if the user is already in a channel
+                removeFromChannel(nickname)
+                # Notify current channel members that user left
+                broadcast(f"{nickname} has left the channel", currentChannel, None, None, True) # Notify other channel members doesn't need to send back msg_sent since it is not a message
+            addToChannel(nickname, requestChannel, clientSocket)
+            broadcast(f"{nickname} has joined the channel {requestChannel}", requestChannel, None, None, True) # Notify other channel members doesn't need to send back msg_sent since it is not a message
+            owned = ownsChannel(requestChannel) # Always true without linked nodes
+            if owned:
+                history = getHistory(requestChannel).page(None, JOIN_HISTORY) # Only copy the latest messages while holding the lock
+
+        # Send the history if its not only the join notify message, formatted after the lock is released
+        if owned:
+            replyHistory(clientSocket, nickname, history, requestChannel, True)
+        else: # Another node keeps the history, it answers after the join message it got from us
+            bus.publish(type="history_request", to=channelOwner(requestChannel), nickname=nickname, channel=requestChannel, beforeId=None, limit=JOIN_HISTORY, join=True)
+    elif msg.startswith("MSG:"): # Send a message to the channel
+        message = msg.split("MSG:",1)[1].strip() # Check if the message is in the correct format
+        with lockUsersChannel(nickname) as currentChannel: # Get the current channel of the user, other channels are not blocked
+            if currentChannel and not allowChannelMessage(currentChannel): # Channel's budget is used up, not the sender's fault so no strike
+                timestamp = datetime.now().strftime("%H.%M")
+                clientSocket.send(f"ERROR:{timestamp}:Channel {currentChannel} is too busy, message not sent".encode("utf-8"))
+            elif currentChannel:
+                broadcast(message, currentChannel, nickname, clientSocket, True) # Broadcast the message to the channel and send confirmation to the sender
+            else:
+                timestamp = datetime.now().strftime("%H.%M") # Notify the client that they are not in any channel
+                clientSocket.send(f"ERROR:{timestamp}:You are not in any channel".encode("utf-8")) #   
+    
+    elif msg.startswith("LIST:"): # List clients or channels
+        listType = msg.split("LIST:",1)[1].strip()
+        if listType == "CLIENTS" or listType == "clients":  # List clients
+            with clientsLock:
+                clientlist = ", ".join(list(clients.keys()) + remoteNicknames()) # Clients of the other workers too
+                clientSocket.send(f"CLIENTS:{clientlist}".encode("utf-8"))
+        elif listType == "channels" or listType == "CHANNELS": # List channels
+            with channelsLock:
+                channellist = ", ".join(list(channels.keys()) + sorted(remoteChannels() - channels.keys()))
+                clientSocket.send(f"CHANNELS:{channellist}".encode("utf-8"))
+                                  
+    elif msg.startswith("HISTORY:"): # Fetch older messages, HISTORY:<channel>:<before_id>:<limit>
+        parts = msg.split("HISTORY:",1)[1].rsplit(":",2) # Split from the right since channel names can contain ':'
+        try:
+            requestChannel = parts[0].strip() or getUsersChannel(nickname) # Empty channel means the current channel
+            beforeId = int(parts[1]) if parts[1].strip() else None # Empty id means the latest messages
+            limit = min(int(parts[2]) if parts[2].strip() else JOIN_HISTORY, MAX_HISTORY_PAGE)
+            if len(parts) != 3 or not requestChannel or limit < 1:
+                raise ValueError
+        except (ValueError, IndexError):
+            timestamp = datetime.now().strftime("%H.%M")
+            clientSocket.send(f"ERROR:{timestamp}:Invalid HISTORY format, use HISTORY:<channel>:<before_id>:<limit>".encode("utf-8"))
+            return False
+        if ownsChannel(requestChannel):
+            entries = getHistoryPage(requestChannel, beforeId, limit) # No channel lock needed, the history has its own
+            replyHistory(clientSocket, nickname, entries, requestChannel, False)
+        else: # Asked from the node that owns the channel
+            bus.publish(type="history_request", to=channelOwner(requestChannel), nickname=nickname, channel=requestChannel, beforeId=beforeId, limit=limit, join=False)
+
+    elif msg.startswith("DM:"): # Send a private message
+        parts = msg.split("DM:",1)[1].split(":",1)
+        if len(parts) == 2: # Check if the message is in the correct format
+            receiver = parts[0].strip()
+            content = parts[1].strip()
+            privatemessage(content, nickname, receiver, clientSocket) # Send the private message
         else:
             timestamp = datetime.now().strftime("%H.%M")
-            clientSocket.send(f"ERROR:{timestamp}:User {receiver} not found".encode("utf-8")) # Notify sender that the user was not found
+            clientSocket.send(f"ERROR:{timestamp}:Invalid DM format".encode("utf-8")) # Notify the client of the invalid format
+            
+    elif msg.startswith("QUIT"): # Disconnect the client
+        cleanupClient(nickname, clientSocket) # Notify other channel members and disconnect the client
+        clientSocket.close()
+        return True
     return False
 
+# Function for removing a client that quit or dropped
+def cleanupClient(nickname, clientSocket):
+    with lockUsersChannel(nickname) as currentChannel:
+        if not ownsNickname(nickname, clientSocket):
+            return # Already removed, for example by broadcast, and the nickname may belong to someone else now
+        if currentChannel:
+            broadcast(f"{nickname} has left the channel", currentChannel, nickname, None, True) # Notify other channel members doesn't need to send back msg_sent since it is not a message
+        disconnectClient(nickname, True)
+
+# Stand-in for the socket of a client whose connection dropped, holds its place until it resumes or the grace period ends
+# Channel messages are replayed from the history on resume, private messages are kept here
+class ParkedSession:
+    def __init__(self, nickname, token, channel, lastSeenId):
+        self.nickname = nickname
+        self.token = token
+        self.channel = channel # Channel the client was in
+        self.lastSeenId = lastSeenId # Latest message of the channel when the client dropped, None if the history is on another node
+        self.missed = deque(maxlen=OUTBOUND_QUEUE_SIZE) # Private messages that arrived in the meantime
+        self.closed = False # Resumed or expired
+        self.lastActivity = time.time()
+
+    def send(self, data):
+        self.missed.append(data)
+        return len(data)
+
+    def sendFrame(self, frame):
+        pass # Channel messages are replayed from the history
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+# Function for a client whose connection dropped without QUIT, keeps its session for RESUME_GRACE seconds if resuming is on
+def dropClient(nickname, clientSocket):
+    if not RESUME_GRACE or stopping:
+        cleanupClient(nickname, clientSocket)
+        return
+    with lockUsersChannel(nickname) as currentChannel:
+        if not ownsNickname(nickname, clientSocket):
+            return # Already removed, for example because it was too slow
+        lastSeenId = None
+        if currentChannel and ownsChannel(currentChannel):
+            lastSeenId = getHistory(currentChannel).nextId - 1
+        removeFromChannel(nickname) # Quietly, the others only hear about it if the client doesn't come back
+        with clientsLock:
+            session = ParkedSession(nickname, clients[nickname]['token'], currentChannel, lastSeenId)
+            clients[nickname]['socket'] = session # Keeps the nickname taken
+            sessions[session.token] = session
+    idleTimers.schedule(session, session.lastActivity + RESUME_GRACE)
+    log("info", "session_parked", f"{nickname} dropped, keeping the session for {RESUME_GRACE} seconds", nickname=nickname)
+
+# Function for ending the session of a dropped client that didn't come back in time
+def expireSession(session):
+    nickname = session.nickname
+    with lockChannels(session.channel): # Same lock as resumeSession so only one of them wins
+        with clientsLock:
+            sessions.pop(session.token, None)
+            session.closed = True
+            if not (nickname in clients and clients[nickname]['socket'] is session):
+                return # Resumed or removed in the meantime
+            removeClient(nickname)
+        if session.channel:
+            broadcast(f"{nickname} has left the channel", session.channel, None, None, True)
+    log("info", "disconnect", f"{nickname} disconnected", nickname=nickname)
+
+# Function for giving a reconnected client its session back, returns the nickname or None if the token is not valid
+def resumeSession(token, clientSocket):
+    with clientsLock:
+        session = sessions.get(token)
+    timestamp = datetime.now().strftime("%H.%M")
+    if not session:
+        clientSocket.send(f"ERROR:{timestamp}:Session expired, log in with your nickname".encode("utf-8"))
+        return None
+    nickname = session.nickname
+    with lockChannels(session.channel): # Same lock as expireSession so only one of them wins
+        with clientsLock:
+            if sessions.get(token) is not session: # Expired while waiting for the lock
+                clientSocket.send(f"ERROR:{timestamp}:Session expired, log in with your nickname".encode("utf-8"))
+                return None
+            del sessions[token]
+            session.closed = True # Grace timer skips it now
+            clients[nickname]['socket'] = clientSocket
+            clients[nickname]['token'] = secrets.token_urlsafe(16) # A token works only once
+            clientSocket.nickname = nickname
+            clientSocket.lastActivity = time.time()
+            idleTimers.schedule(clientSocket, clientSocket.lastActivity + clientTimeout)
+            clientSocket.send(f"INFO:{timestamp}:Welcome back {nickname}".encode("utf-8"))
+            clientSocket.send(f"SESSION:{clients[nickname]['token']}".encode("utf-8"))
+        for data in session.missed: # Private messages that came while the client was away
+            clientSocket.send(data)
+        if session.channel:
+            addToChannel(nickname, session.channel, clientSocket)
+            if session.lastSeenId is not None: # Only what was said while the client was away, still under the lock so nothing is sent twice
+                missed = [entry for entry in getHistory(session.channel).page(None, MAX_HISTORY_PAGE) if entry.id > session.lastSeenId]
+                if missed:
+                    sendHistory(clientSocket, nickname, missed, session.channel)
+            else: # History is on the node that owns the channel
+                bus.publish(type="history_request", to=channelOwner(session.channel), nickname=nickname, channel=session.channel, beforeId=None, limit=JOIN_HISTORY, join=True)
+    log("info", "session_resumed", f"{nickname} resumed the session", nickname=nickname)
+    return nickname
+
+# Socket wrapper used by the threaded engine
+# send only puts the framed message in a bounded queue, a writer thread per client does the actual sending
+class ClientSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.queue = deque() # Framed messages waiting to be sent
+        self.condition = threading.Condition() # Wakes the writer when there is something to send
+        self.closed = False
+        self.nickname = None # Set when the nickname is accepted
+        self.lastActivity = time.time() # Last time the client sent something, read by the idle timer
+        self.buckets = {} # Rate limit buckets of this connection, command to TokenBucket
+        self.writerThread = threading.Thread(target=self.writeLoop)
+        self.writerThread.daemon = True
+        self.writerThread.start()
+
+    def send(self, data):
+        self.sendFrame(frameMessage(data))
+        return len(data)
+
+    def sendFrame(self, frame): # Queue bytes that are already framed, broadcast shares one frame between all members
+        with self.condition:
+            if self.closed:
+                raise ConnectionError("Connection is closed")
+            if len(self.queue) >= OUTBOUND_QUEUE_SIZE and not makeRoom(self.queue):
+                self.abort()
+                raise ConnectionError("Client is too slow, outbound queue is full")
+            self.queue.append(frame)
+            self.condition.notify()
+        if metrics:
+            metrics.messagesOut.inc()
+
+    def writeLoop(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.queue and not self.closed:
+                        self.condition.wait()
+                    if not self.queue: # Closed and everything is sent
+                        break
+                    frames = list(self.queue)
+                    self.queue.clear()
+                chunks = [b"".join(frames)] if FRAMED else frames # Unframed clients take one recv as one message, so each message gets its own send
+                for data in chunks:
+                    self.sock.sendall(data) # Outside the lock so send() never waits for the socket
+                    if metrics:
+                        metrics.bytesSent.inc(len(data))
+        except OSError:
+            if metrics:
+                metrics.sendErrors.inc()
+            self.abort() # Wakes up the reading thread so the client gets cleaned up
+        finally:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR) # close() alone doesn't wake a thread blocked in recv
+                self.sock.close()
+            except OSError:
+                pass
+
+    def abort(self): # Drop pending messages and shut the connection down right away
+        with self.condition:
+            self.closed = True
+            self.queue.clear()
+            self.condition.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def close(self): # Writer closes the socket after the queued messages are sent
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def waitClosed(self, timeout=None):
+        self.writerThread.join(timeout)
+
+# Generator for reading complete messages from a client, ends when the client disconnects
+def readMessages(clientSocket):
+    frames = FrameBuffer()
+    while True:
+        data = clientSocket.recv(RECV_SIZE)
+        if not data:
+            return
+        for msg in frames.feed(data):
+            yield msg
+
 # Function for handling client
 def handleClient(clientSocket, clientAddress):
+    rawSocket = clientSocket
+    clientSocket = None # ClientSocket once its writer thread is running
     nickname = None
     disconnetionCheck = False # Flag to check if the client is disconnected
-    defaultChannel = "general" # Default channel for new clients
     try:
-        while not nickname:  # Get nickname from client
-            msg = clientSocket.recv(1024).decode("utf-8")
-            if not msg:
-                return  # Client disconnected during nickname setup
-            if msg.startswith("NICKNAME:"):
-                requestNickname = msg.split("NICKNAME:",1)[1].strip()
-                
-                # Basic nickname validation
-                if len(requestNickname) < 2 or len(requestNickname) > 20: # Check if the nickname is between 2-20 characters
-                    timestamp = datetime.now().strftime("%H.%M")
-                    clientSocket.send(f"ERROR:{timestamp}:Nickname must be between 2-20 characters".encode("utf-8"))
-                    continue
-                
-                with clientsLock:  # Check if nickname is already taken
-                    nicknameTaken = False
-                    for nick in clients: 
-                        if nick.lower() == requestNickname.lower(): # Check if the nickname is already taken
-                            nicknameTaken = True
-                            break
-                            
-                    if nicknameTaken: # Notify client that the nickname is already taken
-                        timestamp = datetime.now().strftime("%H.%M")
-                        clientSocket.send(f"ERROR:{timestamp}:Nickname already taken".encode("utf-8"))
-                    else:
-                        # Add client to clients dictionary
-                        clients[requestNickname] = {
-                            'socket': clientSocket, 
-                            'lastActivity': time.time(),
-                        }
-                        nickname = requestNickname # Set the nickname
-                        timestamp = datetime.now().strftime("%H.%M")
-                        clientSocket.send(f"INFO:{timestamp}:Welcome {nickname}".encode("utf-8"))
-                        print(f"{nickname} connected")
+        clientSocket = ClientSocket(rawSocket) # Starting the writer can fail when the process is out of threads
+        messages = readMessages(clientSocket)
+        for msg in messages:  # Get nickname from client
+            nickname = registerNickname(msg, clientSocket)
+            if nickname:
+                break
+        if not nickname:
+            return  # Client disconnected during nickname setup
         
         # Add client to default channel
-        with acquirelocks():
-            if defaultChannel not in channels:
-                channels[defaultChannel] = set()
-            channels[defaultChannel].add(nickname)
-            broadcast(f"{nickname} has joined the {defaultChannel}", defaultChannel, None, None, True) # Notify other channel members doesn't need to send back msg_sent since it is not a message
+        joinDefaultChannel(nickname, clientSocket)
         
-        while True:
-            msg = clientSocket.recv(1024).decode("utf-8") # Receive messages from the client
-            if not msg:
-                break
-            
-            # Update last activity time whenever a message is received
-            with clientsLock:
-                if nickname in clients:
-                    clients[nickname]['lastActivity'] = time.time()
-            # Handle different message types
-            if msg.startswith("JOIN:"): # Join a channel
-                requestChannel = msg.split("JOIN:",1)[1].strip()
-                with clientsLock: 
-                    with channelsLock:
-                        currentChannel = getUsersChannel(nickname, True) # Get the current channel of the user
-                        if currentChannel and currentChannel != requestChannel: # Check if the user is already in a channel
-                            channels[currentChannel].discard(nickname)
-                            # Notify current channel members that user left
-                            broadcast(f"{nickname} has left the channel", currentChannel, None, None, True) # Notify other channel members doesn't need to send back msg_sent since it is not a message
-                        if requestChannel not in channels: # Create the channel if it doesn't exist
-                            channels[requestChannel] = set()
-                        channels[requestChannel].add(nickname)
-                        broadcast(f"{nickname} has joined the channel {requestChannel}", requestChannel, None, None, True) # Notify other channel members doesn't need to send back msg_sent since it is not a message
-
-                        # Update the history sending part in handleClient and its not the first notify message
-                        if requestChannel in messageHistory and len(messageHistory[requestChannel]) > 1:
-                            timestamp = datetime.now().strftime("%H.%M")
-                            
-                            # Send a header to mark the beginning of history
-                            clientSocket.send(f"INFO:{timestamp}:--- Begin History ---\n".encode("utf-8"))
-                            
-                            # Send each history entry
-                            for entry in messageHistory[requestChannel]:
-                                if entry['sender'] == nickname:
-                                    sendername = "You"
-                                else:
-                                    sendername = entry.get('sender', 'Server') # Get the sender name or default to 'Server'
-                                msg_timestamp = entry.get('time', 'unknown') # Get the message timestamp or default to 'unknown'
-                                clientSocket.send(f"HISTORY:{msg_timestamp}:{sendername}:{entry['message']}\n".encode("utf-8"))
-                            
-                            # Send a footer to mark the end of history
-                            clientSocket.send(f"INFO:{timestamp}:--- End History ---\n".encode("utf-8"))
-            elif msg.startswith("MSG:"): # Send a message to the channel
-                message = msg.split("MSG:",1)[1].strip() # Check if the message is in the correct format
-                with clientsLock:
-                    with channelsLock:
-                        currentChannel = getUsersChannel(nickname, True) # Get the current channel of the user
-                        if currentChannel:
-                            broadcast(message, currentChannel, nickname, clientSocket, True) # Broadcast the message to the channel and send confirmation to the sender
-                        else:
-                            timestamp = datetime.now().strftime("%H.%M") # Notify the client that they are not in any channel
-                            clientSocket.send(f"ERROR:{timestamp}:You are not in any channel".encode("utf-8")) #   
-            
-            elif msg.startswith("LIST:"): # List clients or channels
-                listType = msg.split("LIST:",1)[1].strip()
-                if listType == "CLIENTS" or listType == "clients":  # List clients
-                    with clientsLock:
-                        clientlist = ", ".join(clients.keys())
-                        clientSocket.send(f"CLIENTS:{clientlist}".encode("utf-8"))
-                elif listType == "channels" or listType == "CHANNELS": # List channels
-                    with channelsLock:
-                        channellist = ", ".join(channels.keys())
-                        clientSocket.send(f"CHANNELS:{channellist}".encode("utf-8"))
-                                              
-            elif msg.startswith("DM:"): # Send a private message
-                parts = msg.split("DM:",1)[1].split(":",1)
-                if len(parts) == 2: # Check if the message is in the correct format
-                    receiver = parts[0].strip()
-                    content = parts[1].strip()
-                    privatemessage(content, nickname, receiver, clientSocket) # Send the private message
-                else:
-                    timestamp = datetime.now().strftime("%H.%M")
-                    clientSocket.send(f"ERROR:{timestamp}:Invalid DM format".encode("utf-8")) # Notify the client of the invalid format
-                    
-            elif msg.startswith("QUIT"): # Disconnect the client
-                with acquirelocks():
-                    currentChannel = getUsersChannel(nickname, True)
-                    if currentChannel:
-                        broadcast(f"{nickname} has left the channel", currentChannel, nickname, None, True) # Notify other channel members doesn't need to send back msg_sent since it is not a message
-                    disconnectClient(nickname, True)  # Disconnect the client
-                    disconnetionCheck = True # Set the disconnection check flag to true
-                clientSocket.close()
+        for msg in messages: # Receive messages from the client
+            if handleCommand(msg, nickname, clientSocket): # Client sent QUIT
+                disconnetionCheck = True # Set the disconnection check flag to true
                 break
                 
     except Exception as e:
-        print(f"Error handling client {clientAddress}: {e}") # Print the error
+        log("error", "client_error", f"Error handling client {clientAddress}: {e}", address=clientAddress, error=str(e))
     finally: # Disconnect the client and close the socket if an error occurs and to be sure that client is disconnected
         if nickname and not disconnetionCheck: # Check if the nickname is set and the client is not already disconnected
-            with clientsLock:
-                with channelsLock:
-                    currentChannel = getUsersChannel(nickname, True)
-                    if currentChannel:
-                        broadcast(f"{nickname} has left the channel", currentChannel, nickname, None, True)
-                    disconnectClient(nickname, True)
+            dropClient(nickname, clientSocket)
+            log("info", "close", f"Connection closed: {clientAddress}", address=clientAddress)
+        if clientSocket:
+            clientSocket.close() # Also stops the writer thread
+        else:
+            rawSocket.close()
+        releaseConnection(clientAddress)
+
+# Socket like wrapper for asyncio streams so broadcast and the other helpers can keep calling send()
+# Works like ClientSocket but the writer is a task on the event loop instead of a thread
+class AsyncClientSocket:
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = deque() # Framed messages waiting to be sent
+        self.ready = asyncio.Event() # Wakes the writer when there is something to send
+        self.closed = False
+        self.nickname = None # Set when the nickname is accepted
+        self.lastActivity = time.time() # Last time the client sent something, read by the idle timer
+        self.buckets = {} # Rate limit buckets of this connection, command to TokenBucket
+        self.writerTask = asyncio.create_task(self.writeLoop())
+
+    def send(self, data):
+        self.sendFrame(frameMessage(data))
+        return len(data)
+
+    def sendFrame(self, frame): # Queue bytes that are already framed
+        if self.closed:
+            raise ConnectionError("Connection is closed")
+        if len(self.queue) >= OUTBOUND_QUEUE_SIZE and not makeRoom(self.queue):
+            self.abort()
+            raise ConnectionError("Client is too slow, outbound queue is full")
+        self.queue.append(frame)
+        self.ready.set()
+        if metrics:
+            metrics.messagesOut.inc()
+
+    async def writeLoop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                while self.queue:
+                    frame = self.queue.popleft()
+                    self.writer.write(frame)
+                    await self.writer.drain() # Waits while the socket is full, new messages stay in the bounded queue
+                    if metrics:
+                        metrics.bytesSent.inc(len(frame))
+                if self.closed:
+                    break
+        except (OSError, RuntimeError):
+            if metrics:
+                metrics.sendErrors.inc()
+            self.abort()
+        finally:
+            self.writer.close()
+
+    def abort(self): # Drop pending messages and shut the connection down right away
+        self.closed = True
+        self.queue.clear()
+        self.ready.set()
+        self.writer.transport.abort() # Ends the reader so the client gets cleaned up
+
+    def close(self): # Writer closes the stream after the queued messages are sent
+        self.closed = True
+        self.ready.set()
+
+# Asyncio version of readMessages
+async def readMessagesAsync(reader):
+    frames = FrameBuffer()
+    while True:
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            return
+        for msg in frames.feed(data):
+            yield msg
+
+# Function for handling client in the asyncio engine, same protocol as handleClient
+async def handleAsyncClient(reader, writer):
+    clientAddress = writer.get_extra_info("peername")
+    reason = admitConnection(clientAddress)
+    if reason: # Turned away before anything is set up for it
+        writer.write(rejectionFrame(clientAddress, reason))
+        writer.close()
+        return
+    clientSocket = AsyncClientSocket(writer)
+    log("info", "connect", f"Connection from {clientAddress}", address=clientAddress)
+    nickname = None
+    disconnetionCheck = False # Flag to check if the client is disconnected
+    asyncHandlers.add(asyncio.current_task())
+    try:
+        messages = readMessagesAsync(reader)
+        async for msg in messages:  # Get nickname from client
+            nickname = registerNickname(msg, clientSocket)
+            if nickname:
+                break
+        if not nickname:
+            return  # Client disconnected during nickname setup
+        
+        # Add client to default channel
+        joinDefaultChannel(nickname, clientSocket)
+        
+        async for msg in messages: # Receive messages from the client
+            if handleCommand(msg, nickname, clientSocket): # Client sent QUIT
+                disconnetionCheck = True
+                break
+                
+    except asyncio.CancelledError: # Server is stopping, the session isn't kept for a resume
+        disconnetionCheck = True
+    except Exception as e:
+        log("error", "client_error", f"Error handling client {clientAddress}: {e}", address=clientAddress, error=str(e))
+    finally:
+        asyncHandlers.discard(asyncio.current_task())
+        if nickname and not disconnetionCheck:
+            dropClient(nickname, clientSocket)
+            log("info", "close", f"Connection closed: {clientAddress}", address=clientAddress)
+        clientSocket.close()
+        releaseConnection(clientAddress)
+
+# Socket wrapper for the selectors engine, the socket is non blocking and only used from the reactor thread
+# Outgoing frames wait in a bounded queue until the socket is writable, incoming bytes are reassembled by a FrameBuffer
+class SelectorClientSocket:
+    def __init__(self, sock, address, reactor):
+        self.sock = sock
+        self.address = address
+        self.reactor = reactor
+        self.frames = FrameBuffer() # Read buffer
+        self.queue = deque() # Framed messages waiting to be sent
+        self.pending = None # Part of the queue that has been taken out but not fully sent yet
+        self.events = selectors.EVENT_READ # Events the selector is watching for
+        self.closed = False # No more sending or reading, the socket closes once everything is sent
+        self.done = False # Socket is closed and unregistered
+        self.nickname = None # Set when the nickname is accepted
+        self.lastActivity = time.time() # Last time the client sent something, read by the idle timer
+        self.buckets = {} # Rate limit buckets of this connection, command to TokenBucket
+
+    def send(self, data):
+        self.sendFrame(frameMessage(data))
+        return len(data)
+
+    def sendFrame(self, frame): # Queue bytes that are already framed, written when the socket is writable
+        if self.closed:
+            raise ConnectionError("Connection is closed")
+        if len(self.queue) >= OUTBOUND_QUEUE_SIZE and not makeRoom(self.queue):
+            self.abort()
+            raise ConnectionError("Client is too slow, outbound queue is full")
+        self.queue.append(frame)
+        self.updateEvents()
+        if metrics:
+            metrics.messagesOut.inc()
+
+    def handleRead(self):
+        try:
+            data = self.sock.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data: # Client disconnected
+            self.disconnect()
+            return
+        try:
+            for msg in self.frames.feed(data):
+                if self.nickname is None: # Get nickname from client
+                    if registerNickname(msg, self):
+                        joinDefaultChannel(self.nickname, self) # Add client to default channel
+                elif handleCommand(msg, self.nickname, self): # Client sent QUIT, handleCommand already closed us
+                    break
+        except Exception as e:
+            log("error", "client_error", f"Error handling client {self.address}: {e}", address=self.address, error=str(e))
+            self.disconnect()
+
+    def handleWrite(self):
+        try:
+            while self.pending or self.queue:
+                if not self.pending:
+                    if FRAMED: # Everything queued in one send, the reader splits it by the length prefixes
+                        self.pending = memoryview(b"".join(self.queue))
+                        self.queue.clear()
+                    else: # Unframed clients take one recv as one message
+                        self.pending = memoryview(self.queue.popleft())
+                sent = self.sock.send(self.pending)
+                self.pending = self.pending[sent:]
+                if metrics:
+                    metrics.bytesSent.inc(sent)
+        except BlockingIOError:
+            pass # Socket buffer is full, continue when it is writable again
+        except OSError:
+            if metrics:
+                metrics.sendErrors.inc()
+            self.disconnect()
+            return
+        self.updateEvents()
+
+    def updateEvents(self): # Watch for writable only while there is something to send
+        if self.done:
+            return
+        wantWrite = bool(self.pending or self.queue)
+        if self.closed and not wantWrite:
+            self.closeNow()
+            return
+        events = (0 if self.closed else selectors.EVENT_READ) | (selectors.EVENT_WRITE if wantWrite else 0)
+        if events != self.events:
+            self.reactor.selector.modify(self.sock, events, self)
+            self.events = events
+
+    def abort(self): # Drop pending messages, the client is cleaned up by the reactor after the current event
+        self.closed = True
+        self.queue.clear()
+        self.pending = None
+        self.reactor.aborted.append(self)
+
+    def close(self): # Socket is closed after the queued messages are sent
+        self.closed = True
+        self.updateEvents()
+
+    def disconnect(self): # Client went away or broke, remove it from the server
+        if self.done:
+            return
+        self.closed = True
+        self.closeNow()
+        if self.nickname:
+            dropClient(self.nickname, self) # Does nothing if the client already quit or was removed
+            log("info", "close", f"Connection closed: {self.address}", address=self.address)
+
+    def closeNow(self):
+        self.done = True
+        try:
+            self.reactor.selector.unregister(self.sock)
+        except (KeyError, ValueError):
+            pass
+        self.sock.close()
+        releaseConnection(self.address)
+
+# Event loop for the selectors engine, every client is handled in this one thread
+class Reactor:
+    def __init__(self, serverSocket):
+        self.serverSocket = serverSocket
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(serverSocket, selectors.EVENT_READ, None)
+        self.aborted = [] # Connections dropped while handling another connection, for example by broadcast
+        self.callbacks = deque() # Functions queued from other threads, run on the reactor thread
+        self.wakeupReader, self.wakeupWriter = socket.socketpair() # Wakes up select when a callback is queued
+        self.wakeupReader.setblocking(False)
+        self.wakeupWriter.setblocking(False)
+        self.selector.register(self.wakeupReader, selectors.EVENT_READ, self)
+
+    def acceptConnections(self):
+        while True: # Accept everything waiting in the backlog
             try:
-                clientSocket.close()
-            except:
+                sock, address = self.serverSocket.accept()
+            except BlockingIOError:
+                return
+            except OSError as e: # For example out of file descriptors, try again on the next event
+                log("error", "accept_error", f"Error accepting connection: {e}", error=str(e))
+                return
+            reason = admitConnection(address)
+            if reason:
+                rejectConnection(sock, address, reason)
+                continue
+            sock.setblocking(False)
+            log("info", "connect", f"Connection from {address}", address=address)
+            self.selector.register(sock, selectors.EVENT_READ, SelectorClientSocket(sock, address, self))
+
+    def callSoon(self, function, *args): # Thread safe, the function runs on the reactor thread
+        self.callbacks.append((function, args))
+        try:
+            self.wakeupWriter.send(b"\0")
+        except BlockingIOError:
+            pass # Buffer is full of wakeups already
+
+    def runCallbacks(self):
+        try:
+            while self.wakeupReader.recv(RECV_SIZE):
                 pass
-            print(f"Connection closed: {clientAddress}")
+        except BlockingIOError:
+            pass
+        while self.callbacks:
+            function, args = self.callbacks.popleft()
+            try:
+                function(*args)
+            except Exception as e:
+                log("error", "callback_error", f"Error in reactor callback: {e}", error=str(e))
+
+    def poll(self, timeout):
+        for key, events in self.selector.select(timeout):
+            if key.data is None:
+                self.acceptConnections()
+            elif key.data is self:
+                self.runCallbacks() # Bus messages can broadcast and abort clients too
+            else:
+                clientSocket = key.data
+                if events & selectors.EVENT_READ and not clientSocket.done:
+                    clientSocket.handleRead()
+                if events & selectors.EVENT_WRITE and not clientSocket.done:
+                    clientSocket.handleWrite()
+            self.disconnectAborted()
+
+    def disconnectAborted(self): # Called after anything that can abort a client, otherwise its socket would stay open
+        while self.aborted:
+            self.aborted.pop().disconnect()
+
+    def connectionCount(self):
+        return sum(isinstance(key.data, SelectorClientSocket) for key in self.selector.get_map().values())
+
+# Function for starting the selectors server, one thread handles every client without asyncio
+def startSelectorServer():
+    handoff = takeOver(HANDOFF_PATH) if HANDOFF_PATH else None # Hot restart if a server is already running there
+    if handoff:
+        serverSocket = socket.socket(fileno=handoff[0][0])
+    else:
+        serverSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # TCP socket
+        serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Reuse the socket
+        if WORKERS > 1:
+            serverSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Every worker listens on the same port, the kernel spreads the connections
+        serverSocket.bind(SERVERADDRESS) # Bind to the address
+        serverSocket.listen(LISTEN_BACKLOG) # Listen for connections
+    serverSocket.setblocking(False)
+    reactor = Reactor(serverSocket)
+    if handoff:
+        restoreState(handoff[1], handoff[0][1:], reactor)
+    if HANDOFF_PATH:
+        HandoffListener(HANDOFF_PATH, reactor)
+    if bus:
+        bus.start(lambda message: reactor.callSoon(handleBusMessage, message)) # Handled on the reactor thread
+    printServerInfo()
+    nextCheck = time.time() + clientsCheckInterval
+    try:
+        while True:
+            reactor.poll(clientsCheckInterval)
+            if time.time() >= nextCheck: # Idle timeouts are checked in the same thread
+                disconnectInactiveClients()
+                reactor.disconnectAborted()
+                nextCheck = time.time() + clientsCheckInterval
+    except HandedOff: # The new process has every connection, leave without telling the clients
+        log("info", "stop", "Server stopped, the new process took over")
+    except KeyboardInterrupt:
+        notifyShutdown()
+        deadline = time.time() + 1 # Give the clients a moment to receive the shutdown message
+        while reactor.connectionCount() and time.time() < deadline:
+            reactor.poll(0.1)
+        if historyLog:
+            historyLog.close() # Make sure the latest messages are on disk
+        serverSocket.close() # Close the server socket
+        log("info", "stop", "Server stopped")
+
+# Exception for leaving the reactor loop after the connections were given to a new server process
+class HandedOff(Exception):
+    pass
+
+# Unix socket where the running server waits for its replacement, registered in the reactor so the handoff runs between events
+class HandoffListener:
+    def __init__(self, path, reactor):
+        if os.path.exists(path): # Left over from a server that didn't stop cleanly
+            os.unlink(path)
+        self.path = path
+        self.reactor = reactor
+        self.done = False # Read by the reactor like on a client
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(1)
+        self.sock.setblocking(False)
+        reactor.selector.register(self.sock, selectors.EVENT_READ, self)
+
+    def handleRead(self):
+        try:
+            conn, address = self.sock.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(True)
+        conn.settimeout(HANDOFF_TIMEOUT)
+        try:
+            handOff(conn, self.reactor)
+        except (OSError, ValueError) as e: # New process went away, nothing was given up so keep serving
+            log("error", "handoff_error", f"Hot restart failed, still serving: {e}", error=str(e))
+            conn.close()
+            return
+        self.done = True
+        self.reactor.selector.unregister(self.sock)
+        self.sock.close()
+        os.unlink(self.path) # The new process listens here next
+        if historyLog:
+            historyLog.close() # Everything is on disk before the new process starts writing
+        conn.sendall(b"bye")
+        conn.close()
+        raise HandedOff()
+
+    def handleWrite(self):
+        pass
+
+# Function for sending the listening socket, every connection and the server state to a new process over a Unix socket
+# Runs on the reactor thread so nothing is read or written while the state is copied
+def handOff(conn, reactor):
+    connections = [key.data for key in reactor.selector.get_map().values()
+                   if isinstance(key.data, SelectorClientSocket) and not key.data.closed]
+    state = {"framed": FRAMED, "clients": [], "sessions": [], "history": {}}
+    with channelsLock, clientsLock:
+        state["channels"] = list(channels.keys())
+        for clientSocket in connections:
+            nickname = clientSocket.nickname
+            client = clients.get(nickname) if nickname else None
+            state["clients"].append({
+                "address": clientSocket.address,
+                "nickname": nickname if client and client['socket'] is clientSocket else None,
+                "channel": userChannels.get(nickname),
+                "since": client['since'] if client else None,
+                "token": client['token'] if client else None,
+                "lastActivity": clientSocket.lastActivity,
+                "input": base64.b64encode(bytes(clientSocket.frames.buffer)).decode("ascii"), # Part of a message that was not complete yet
+                "output": base64.b64encode(bytes(clientSocket.pending or b"") + b"".join(clientSocket.queue)).decode("ascii"), # Not sent yet
+            })
+        for session in sessions.values():
+            state["sessions"].append({
+                "nickname": session.nickname, "token": session.token, "channel": session.channel, "lastSeenId": session.lastSeenId,
+                "since": clients[session.nickname]['since'], "parkedAt": session.lastActivity,
+                "missed": [base64.b64encode(data).decode("ascii") for data in session.missed],
+            })
+        for channel, history in messageHistory.items():
+            state["history"][channel] = [history.nextId, [[entry.id, entry.time, entry.sender, entry.message] for entry in history.page()]]
+    data = json.dumps(state).encode("utf-8")
+    conn.sendall(FRAME_HEADER.pack(len(data)) + data)
+    fds = [reactor.serverSocket.fileno()] + [clientSocket.sock.fileno() for clientSocket in connections]
+    for start in range(0, len(fds), HANDOFF_BATCH):
+        socket.send_fds(conn, [b"F"], fds[start:start + HANDOFF_BATCH])
+    if receiveExactly(conn, 2) != b"ok":
+        raise ValueError("the new process did not take over")
+    log("info", "handoff", f"Handed {len(connections)} connections over to the new server process", connections=len(connections))
+
+# Helper function for reading exactly count bytes from a blocking socket
+def receiveExactly(sock, count):
+    data = b""
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed during hot restart")
+        data += chunk
+    return data
+
+# Function for taking over from a server waiting at path, returns the file descriptors and the state or None if no server is waiting
+def takeOver(path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    conn.settimeout(HANDOFF_TIMEOUT)
+    (length,) = FRAME_HEADER.unpack(receiveExactly(conn, FRAME_HEADER.size))
+    state = json.loads(receiveExactly(conn, length))
+    fds = []
+    while len(fds) < len(state["clients"]) + 1: # Listening socket comes first
+        data, newFds, flags, address = socket.recv_fds(conn, 1, HANDOFF_BATCH)
+        if not data:
+            raise ConnectionError("connection closed during hot restart")
+        fds += newFds
+    if state["framed"] != FRAMED: # Clients would not understand us, the old server keeps running
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+        raise SystemExit("Hot restart needs the same --framed setting as the running server")
+    conn.sendall(b"ok")
+    receiveExactly(conn, 3) # bye, the old server has stopped and written its history log
+    conn.close()
+    return fds, state
+
+# Function for rebuilding the server state and the connections received from the old server process
+def restoreState(state, fds, reactor):
+    for channel in state["channels"]:
+        channels.setdefault(channel, {})
+    for channel, (nextId, entries) in state["history"].items():
+        history = MessageHistory(MAX_HISTORY)
+        for id, sentAt, sender, message in entries:
+            history.append(HistoryEntry(sender, message, sentAt, id))
+        history.nextId = nextId
+        messageHistory[channel] = history
+    for info, fd in zip(state["clients"], fds):
+        sock = socket.socket(fileno=fd)
+        sock.setblocking(False)
+        clientSocket = SelectorClientSocket(sock, tuple(info["address"]), reactor)
+        admitConnection(clientSocket.address, True) # Already open, only counted
+        clientSocket.frames.buffer += base64.b64decode(info["input"])
+        output = base64.b64decode(info["output"])
+        if output:
+            clientSocket.queue.append(output)
+        clientSocket.lastActivity = info["lastActivity"]
+        reactor.selector.register(sock, selectors.EVENT_READ, clientSocket)
+        clientSocket.updateEvents()
+        nickname = info["nickname"]
+        if nickname:
+            clientSocket.nickname = nickname
+            clients[nickname] = {'socket': clientSocket, 'since': info["since"], 'token': info["token"]}
+            nicknameIndex[nickname.casefold()] = nickname
+            idleTimers.schedule(clientSocket, clientSocket.lastActivity + clientTimeout)
+            if info["channel"]:
+                addToChannel(nickname, info["channel"], clientSocket)
+    for info in state["sessions"]:
+        session = ParkedSession(info["nickname"], info["token"], info["channel"], info["lastSeenId"])
+        session.missed.extend(base64.b64decode(data) for data in info["missed"])
+        session.lastActivity = info["parkedAt"]
+        clients[session.nickname] = {'socket': session, 'since': info["since"], 'token': session.token}
+        nicknameIndex[session.nickname.casefold()] = session.nickname
+        sessions[session.token] = session
+        idleTimers.schedule(session, session.lastActivity + RESUME_GRACE)
+    log("info", "takeover", f"Took over {len(state['clients'])} connections from the old server process", connections=len(state['clients']))
+
+# Helper function for finding a client on another worker case insensitively, returns its remoteUsers entry or None
+def findRemoteUser(nickname):
+    with remoteLock:
+        return remoteUsers.get(nickname.casefold())
+
+def remoteNicknames():
+    with remoteLock:
+        return [user["nickname"] for user in remoteUsers.values()]
+
+def remoteChannels():
+    with remoteLock:
+        return {user["channel"] for user in remoteUsers.values() if user["channel"]}
+
+# Function for recording a client that registered on another worker
+# Two workers can accept the same nickname at the same moment, the one registered first keeps it and every worker decides the same way
+def addRemoteUser(message):
+    nickname = message["nickname"]
+    claim = (message["since"], message["origin"])
+    with clientsLock:
+        localNickname = findClient(nickname)
+        localClient = clients.get(localNickname) if localNickname else None
+    if localClient:
+        if (localClient['since'], bus.origin) < claim:
+            return # Ours was first, the other worker drops its client
+        clientSocket = localClient['socket']
+        try:
+            timestamp = datetime.now().strftime("%H.%M")
+            clientSocket.send(f"ERROR:{timestamp}:Nickname already taken".encode("utf-8"))
+        except:
+            pass
+        cleanupClient(localNickname, clientSocket)
+        clientSocket.close()
+    with remoteLock:
+        user = remoteUsers.get(nickname.casefold())
+        if user and (user["since"], user["origin"]) < claim:
+            return
+        remoteUsers[nickname.casefold()] = {"nickname": nickname, "channel": None, "origin": message["origin"], "since": message["since"]}
+
+# Function for forgetting every client of a worker or node, remoteUsers has its own lock so any thread can call this
+def forgetOrigin(origin):
+    with remoteLock:
+        for key, user in list(remoteUsers.items()):
+            if user["origin"] == origin:
+                del remoteUsers[key]
+
+# Function for delivering a private message sent by a client on another worker
+def deliverPrivateMessage(message):
+    with clientsLock:
+        receiver = findClient(message["receiver"])
+        if receiver:
+            try:
+                clients[receiver]['socket'].send(f"PRIVATE:{message['time']}:{message['sender']}:{message['message']}".encode("utf-8"))
+                clients[receiver]['socket'].lastActivity = time.time()
+                return
+            except Exception as e:
+                log("error", "send_error", f"Error sending DM: {e}", error=str(e))
+                if metrics:
+                    metrics.sendErrors.inc()
+    bus.publish(type="dm_failed", to=message["origin"], sender=message["sender"], receiver=message["receiver"]) # Let the sender know
+
+# Function for applying a message from another worker, runs on the thread the engine handles clients on
+def handleBusMessage(message):
+    kind = message["type"]
+    if kind == "online":
+        addRemoteUser(message)
+    elif kind == "channel" or kind == "offline":
+        key = message["nickname"].casefold()
+        with remoteLock:
+            user = remoteUsers.get(key)
+            if user and user["origin"] == message["origin"]: # Ignore a client that lost its nickname to an earlier one
+                if kind == "channel":
+                    user["channel"] = message["channel"]
+                else:
+                    del remoteUsers[key]
+    elif kind == "gone": # Worker exited or node relinked, its clients are gone or about to be sent again
+        forgetOrigin(message["origin"])
+    elif kind == "broadcast": # From another worker, or sent to this node as the channel's owner
+        with lockChannels(message["channel"]):
+            deliverToChannel(message["message"], message["channel"], message["sender"], message["time"])
+            if channelOwner(message["channel"]) is not None:
+                relayToMemberNodes(message["channel"], message["sender"], message["message"], message["time"], message["origin"])
+    elif kind == "deliver": # Relayed by the channel's owner, it already stored the message
+        with lockChannels(message["channel"]):
+            deliverToChannel(message["message"], message["channel"], message["sender"], message["time"], False)
+    elif kind == "history_request": # Another node's client wants history of a channel this node owns
+        entries = getHistoryPage(message["channel"], message["beforeId"], message["limit"])
+        bus.publish(type="history_reply", to=message["origin"], nickname=message["nickname"], channel=message["channel"], join=message["join"],
+                    entries=[[entry.id, entry.time, entry.sender, entry.message] for entry in entries])
+    elif kind == "history_reply":
+        with clientsLock:
+            nickname = findClient(message["nickname"])
+            clientSocket = clients[nickname]['socket'] if nickname else None
+        if clientSocket:
+            entries = [HistoryEntry(sender, text, time, id) for id, time, sender, text in message["entries"]]
+            replyHistory(clientSocket, nickname, entries, message["channel"], message["join"])
+    elif kind == "dm":
+        deliverPrivateMessage(message)
+    elif kind == "dm_failed":
+        with clientsLock:
+            sender = findClient(message["sender"])
+            if sender:
+                timestamp = datetime.now().strftime("%H.%M")
+                try:
+                    clients[sender]['socket'].send(f"ERROR:{timestamp}:Failed to send message to {message['receiver']}".encode("utf-8"))
+                except Exception:
+                    pass
+
+# Connection of a worker to the bus hub in the parent process, every message is one line of JSON
+# publish only queues the message so it is safe to call while holding locks, a writer thread sends and a reader thread receives
+class WorkerBus:
+    def __init__(self, sock, workerId):
+        self.sock = sock
+        self.origin = workerId # Sent with every message so the others know where it came from
+        self.outbox = queue.SimpleQueue() # Encoded messages waiting for the writer
+
+    def start(self, dispatch): # dispatch gets every message meant for this worker, engines pass one that runs it on their own thread
+        self.dispatch = dispatch
+        for target in (self.writeLoop, self.readLoop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def ownerOf(self, channel): # Every worker sees every message and keeps the history of every channel
+        return None
+
+    def publish(self, **message): # Goes to every other worker, or only to worker "to" if it is given
+        message["origin"] = self.origin
+        self.outbox.put(json.dumps(message).encode("utf-8") + b"\n")
+
+    def writeLoop(self):
+        writeLines(self.sock, self.outbox) # Returns when the hub is gone, the reader notices it too
+
+    def readLoop(self):
+        for message in readLines(self.sock):
+            if message.get("to", self.origin) == self.origin:
+                self.dispatch(message)
+        log("error", "bus_lost", f"Worker {self.origin} lost the worker bus, shutting down") # Parent process is gone
+        os.kill(os.getpid(), signal.SIGTERM)
+
+# Function for sending the encoded messages put in an outbox, batched into one write, until the socket breaks or None is queued
+def writeLines(sock, outbox):
+    while True:
+        batch = [outbox.get()]
+        try:
+            while True: # Everything queued goes out in one write
+                batch.append(outbox.get_nowait())
+        except queue.Empty:
+            pass
+        if None in batch: # Link was closed
+            return
+        try:
+            sock.sendall(b"".join(batch))
+        except OSError:
+            return
+
+# Generator for reading JSON line messages from a bus or peer socket, ends when the connection does
+def readLines(sock):
+    buffer = b""
+    while True:
+        try:
+            data = sock.recv(BUS_RECV_SIZE)
+        except OSError:
+            return
+        if not data:
+            return
+        *lines, buffer = (buffer + data).split(b"\n") # Last piece is an unfinished line
+        if len(buffer) > MAX_LINE: # Don't buffer forever for a broken or hostile peer
+            raise ValueError(f"message longer than {MAX_LINE} bytes")
+        for line in lines:
+            yield json.loads(line)
+
+# Function for relaying bus messages between the workers, runs in the parent process
+# Every complete line from one worker is copied to all the others, the hub doesn't look inside the messages
+def runBusHub(workerSockets):
+    selector = selectors.DefaultSelector()
+    peers = dict(enumerate(workerSockets)) # Worker index to its end of the bus
+    buffers = {}
+    for index, sock in peers.items():
+        selector.register(sock, selectors.EVENT_READ, index)
+        buffers[index] = b""
+    while peers:
+        for key, events in selector.select():
+            index = key.data
+            try:
+                data = key.fileobj.recv(BUS_RECV_SIZE)
+            except OSError:
+                data = b""
+            if not data: # Worker exited
+                selector.unregister(key.fileobj)
+                del peers[index]
+                log("info", "worker_stopped", f"Worker {index} stopped", worker=index)
+                chunk = json.dumps({"type": "gone", "origin": index}).encode("utf-8") + b"\n"
+            else:
+                buffers[index] += data
+                end = buffers[index].rfind(b"\n") + 1 # Only relay whole lines
+                if not end:
+                    continue
+                chunk = buffers[index][:end]
+                buffers[index] = buffers[index][end:]
+            for peer, sock in list(peers.items()):
+                if peer != index:
+                    try:
+                        sock.sendall(chunk)
+                    except OSError:
+                        pass # Noticed as an exit when its socket is read
+
+# Function for placing a string on the hash ring, md5 is only used because it spreads the values evenly
+def ringHash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+# Consistent hash ring for choosing the node that owns a channel
+# Every node is put on the ring at RING_REPLICAS points, a channel belongs to the first node point after the channel's hash
+# When a node comes or goes only the channels next to its points move, the rest keep their owner
+class HashRing:
+    def __init__(self, nodes, replicas=RING_REPLICAS):
+        self.points = sorted((ringHash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self.hashes = [point for point, node in self.points]
+
+    def owner(self, key):
+        index = bisect.bisect(self.hashes, ringHash(key)) % len(self.points) # Wraps around to the first point
+        return self.points[index][1]
+
+# Server to server link in a federation, messages go out through an outbox and a writer thread like on the worker bus
+class PeerLink:
+    def __init__(self, sock, outgoing):
+        self.sock = sock
+        self.outgoing = outgoing # True if this server opened the link
+        self.outbox = queue.SimpleQueue() # Encoded messages waiting for the writer
+        writerThread = threading.Thread(target=writeLines, args=(sock, self.outbox))
+        writerThread.daemon = True
+        writerThread.start()
+
+    def close(self): # Stops the writer and ends the reader
+        self.outbox.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+# Links this server to the other nodes of a federation, has the same publish and start as WorkerBus so the rest of the server works the same
+# Every node needs a link to every other node since messages are not passed on, a link works both ways so one side connecting is enough
+class PeerBus:
+    def __init__(self, nodeId, listenPort, peerAddresses):
+        self.origin = nodeId # Sent with every message so the others know where it came from
+        self.listenPort = listenPort
+        self.peerAddresses = peerAddresses
+        self.links = {} # Node id to its PeerLink
+        self.knownPeers = {} # Address to node id, so a node that already linked to us is not dialled again
+        self.lock = threading.Lock() # Lock for links, taken after clientsLock and before remoteLock
+        self.ring = HashRing([nodeId]) # Channel owners among this node and the linked ones, replaced whenever a link comes or goes
+
+    def start(self, dispatch): # dispatch gets every message from the other nodes, engines pass one that runs it on their own thread
+        self.dispatch = dispatch
+        if self.listenPort:
+            self.startThread(self.acceptLoop)
+        for address in self.peerAddresses:
+            self.startThread(self.connectLoop, address)
+
+    def startThread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def ownerOf(self, channel): # Node that keeps the channel's history, messages in the channel go through it
+        return self.ring.owner(channel)
+
+    def encode(self, **message):
+        message["origin"] = self.origin
+        return json.dumps(message).encode("utf-8") + b"\n"
+
+    def publish(self, **message): # Goes to every linked node, or only to node "to" if it is given
+        data = self.encode(**message)
+        with self.lock:
+            if "to" in message:
+                links = [self.links[message["to"]]] if message["to"] in self.links else []
+            else:
+                links = list(self.links.values())
+        for link in links:
+            link.outbox.put(data)
+
+    def acceptLoop(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((PEER_HOST, self.listenPort))
+        listener.listen()
+        while True:
+            sock, address = listener.accept()
+            self.startThread(self.runLink, sock, False)
+
+    def connectLoop(self, address): # Keeps a link to one configured peer, reconnects when it drops
+        while True:
+            if self.knownPeers.get(address) not in self.links: # Not linked yet, or the peer's own link dropped
+                try:
+                    sock = socket.create_connection(address, timeout=PEER_RETRY_INTERVAL)
+                except OSError:
+                    sock = None # Peer is not up, try again later
+                if sock:
+                    sock.settimeout(None)
+                    self.runLink(sock, True, address)
+            time.sleep(PEER_RETRY_INTERVAL)
+
+    def runLink(self, sock, outgoing, address=None): # Runs until the link breaks
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = PeerLink(sock, outgoing)
+        if outgoing: # The accepting side answers only once the secret checked out, so it never hands the secret to a stranger
+            link.outbox.put(self.encode(type="hello", secret=PEER_SECRET))
+        messages = readLines(sock)
+        try:
+            hello = next(messages, None)
+        except ValueError: # Not a peer speaking JSON
+            hello = None
+        if not hello or hello.get("type") != "hello" or hello.get("origin") in (None, self.origin):
+            link.close()
+            sock.close()
+            return
+        if not hmac.compare_digest(str(hello.get("secret")).encode("utf-8"), PEER_SECRET.encode("utf-8")): # Same time for every wrong guess
+            log("warning", "peer_rejected", f"Rejected a link from node {hello['origin']}: wrong peer secret", node=hello["origin"])
+            link.close()
+            sock.close()
+            return
+        if not outgoing:
+            link.outbox.put(self.encode(type="hello", secret=PEER_SECRET))
+        nodeId = hello["origin"]
+        if address:
+            self.knownPeers[address] = nodeId
+        if not self.addLink(nodeId, link):
+            link.close()
+            sock.close()
+            return
+        log("info", "peer_linked", f"Linked to node {nodeId}", node=nodeId)
+        try:
+            for message in messages:
+                self.dispatch(message)
+        except ValueError as e:
+            log("error", "peer_error", f"Bad message from node {nodeId}: {e}", node=nodeId, error=str(e))
+        with self.lock:
+            lost = self.links.get(nodeId) is link # False if a newer link to the same node replaced this one
+            if lost:
+                del self.links[nodeId]
+                self.ring = HashRing([self.origin, *self.links])
+                forgetOrigin(nodeId) # Under the lock so a new link's clients can't be added first
+        if lost:
+            log("info", "peer_lost", f"Lost link to node {nodeId}", node=nodeId)
+        link.close()
+        sock.close()
+
+    def addLink(self, nodeId, link): # Registers the link and sends it the clients of this node, False if it is not needed
+        with channelsLock, clientsLock: # Nothing changes until the snapshot is queued, later changes follow it on the link
+            with self.lock:
+                existing = self.links.get(nodeId)
+                preferOutgoing = self.origin < nodeId # When both nodes connect at once, both keep the link opened by the smaller id
+                if existing and existing.outgoing == preferOutgoing and link.outgoing != preferOutgoing:
+                    return False
+                self.links[nodeId] = link
+                self.ring = HashRing([self.origin, *self.links])
+            link.outbox.put(self.encode(type="gone")) # The other node drops what it knew about us and takes the full list instead
+            for nickname, client in clients.items():
+                link.outbox.put(self.encode(type="online", nickname=nickname, since=client['since']))
+                if userChannels.get(nickname):
+                    link.outbox.put(self.encode(type="channel", nickname=nickname, channel=userChannels[nickname]))
+        if existing:
+            existing.close() # Its reader sees it was replaced and keeps the node's clients
+        return True
+
+# Function for forking the worker processes and relaying messages between them
+def startWorkers():
+    global workerId, bus
+    workerSockets = []
+    pids = []
+    for index in range(WORKERS):
+        hubEnd, workerEnd = socket.socketpair()
+        pid = os.fork()
+        if pid == 0: # Worker process
+            hubEnd.close()
+            for sock in workerSockets: # Bus ends of the workers forked before this one
+                sock.close()
+            workerId = index
+            startLogging() # The parent's writer thread didn't come along
+            bus = WorkerBus(workerEnd, index)
+            signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C goes to the parent, it stops the workers with SIGTERM
+            signal.signal(signal.SIGTERM, stopWorker)
+            try:
+                runEngine()
+            finally:
+                stopLogging() # os._exit skips atexit
+                os._exit(0) # Don't fall back into the parent's code
+        workerEnd.close()
+        workerSockets.append(hubEnd)
+        pids.append(pid)
+    log("info", "workers_started", f"Started {WORKERS} workers", workers=WORKERS)
+    if LOCK_PROFILE: # Every worker prints its own report
+        signal.signal(signal.SIGUSR1, lambda signum, frame: [os.kill(pid, signal.SIGUSR1) for pid in pids])
+    try:
+        runBusHub(workerSockets)
+    except KeyboardInterrupt:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+# Signal handler of the workers, SIGTERM shuts the engine down the same way as Ctrl+C does without workers
+def stopWorker(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN) # Only stop once
+    raise KeyboardInterrupt
+
+# Function for running the selected engine in this process
+def runEngine():
+    global historyLog
+    if METRICS_PORT:
+        startMetrics(METRICS_PORT + workerId) # Every worker has its own numbers
+    if LOCK_PROFILE:
+        startLockProfiler() # After the metrics, the profiled locks feed them too
+    if HISTORY_DIR:
+        directory = os.path.join(HISTORY_DIR, f"worker{workerId}") if WORKERS > 1 else HISTORY_DIR # Every worker sees every message so each keeps a full log
+        historyLog = HistoryLog(directory, fsyncInterval=HISTORY_FSYNC_INTERVAL)
+    if ENGINE == "asyncio":
+        startAsyncServer()
+    elif ENGINE == "selectors":
+        startSelectorServer()
+    else:
+        startServer()
 
 # Start server
-startServer()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--engine", choices=["threaded", "asyncio", "selectors"], default=ENGINE, help="Server engine to use")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Worker processes sharing the port, needs SO_REUSEPORT and fork")
+    parser.add_argument("--node-id", default=NODE_ID, help="Name of this server among linked servers, default hostname:port")
+    parser.add_argument("--peer-port", type=int, default=PEER_PORT, help="Port other servers link to")
+    parser.add_argument("--peer-host", default=PEER_HOST, help="Interface the peer port listens on, 0.0.0.0 for servers on other machines")
+    parser.add_argument("--peer-secret", default=os.environ.get("PEER_SECRET", PEER_SECRET), help="Shared secret of the linked servers, the PEER_SECRET environment variable keeps it out of the process list")
+    parser.add_argument("--peer", action="append", default=[], help="host:port of another server's peer port, can be given several times")
+    parser.add_argument("--port", type=int, default=PORT, help="Port to listen on")
+    parser.add_argument("--framed", action="store_true", default=FRAMED, help="Use length prefixed message framing, clients must use --framed too")
+    parser.add_argument("--queue-size", type=int, default=OUTBOUND_QUEUE_SIZE, help="Outbound messages queued per client")
+    parser.add_argument("--history-size", type=int, default=MAX_HISTORY, help="Messages kept in memory per channel")
+    parser.add_argument("--join-history", type=int, default=JOIN_HISTORY, help="Latest messages sent when joining a channel")
+    parser.add_argument("--history-dir", default=HISTORY_DIR, help="Keep channel history on disk in this folder")
+    parser.add_argument("--fsync-interval", type=float, default=HISTORY_FSYNC_INTERVAL, help="Seconds between fsyncs of the history log")
+    parser.add_argument("--resume-grace", type=int, default=RESUME_GRACE, help="Seconds a dropped client can resume its session, 0 turns it off")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="Serve Prometheus style metrics on this localhost port, worker n uses port + n")
+    parser.add_argument("--lock-profile", action="store_true", default=LOCK_PROFILE, help="Record lock wait and hold times per call site, kill -USR1 <pid> prints the report")
+    parser.add_argument("--log-format", choices=["text", "json"], default=LOG_FORMAT, help="Plain log lines or one JSON record per line")
+    parser.add_argument("--log-level", choices=list(LOG_LEVELS), default=LOG_LEVEL, help="Lowest level logged")
+    parser.add_argument("--log-error-rate", type=int, default=LOG_ERROR_RATE, help="Warning and error records of one kind logged per second, the rest are counted")
+    parser.add_argument("--rate-limit", action="append", default=[], metavar="COMMAND=RATE[/BURST]", help="Per connection limit for MSG, DM, JOIN or LIST in commands per second, 0 turns it off, can be given several times")
+    parser.add_argument("--channel-rate", default="0", metavar="RATE[/BURST]", help="Messages per second for each channel, shared by its members (default off)")
+    parser.add_argument("--flood-strikes", type=int, default=FLOOD_STRIKES, help=f"Rejected commands within {FLOOD_WINDOW} seconds before a client is disconnected, 0 never disconnects")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="Open connections at once, more are rejected with an ERROR, 0 for no limit")
+    parser.add_argument("--max-connections-per-ip", type=int, default=MAX_CONNECTIONS_PER_IP, help="Open connections from one address, 0 for no limit")
+    parser.add_argument("--backlog", type=int, default=LISTEN_BACKLOG, help="Connections waiting for accept that the kernel keeps, more are refused")
+    parser.add_argument("--handoff-path", default=HANDOFF_PATH, help="Unix socket for hot restarts, a new server started with the same path takes over all connections (selectors engine)")
+    parser.add_argument("--slow-client-policy", choices=["drop_oldest", "disconnect", "coalesce"], default=SLOW_CLIENT_POLICY, help="What to do when a client's outbound queue is full")
+    args = parser.parse_args()
+    LOG_FORMAT = args.log_format
+    LOG_LEVEL = args.log_level
+    LOG_ERROR_RATE = args.log_error_rate
+    startLogging()
+    PORT = args.port
+    FRAMED = args.framed
+    OUTBOUND_QUEUE_SIZE = args.queue_size
+    SLOW_CLIENT_POLICY = args.slow_client_policy
+    MAX_HISTORY = args.history_size
+    JOIN_HISTORY = args.join_history
+    RESUME_GRACE = args.resume_grace
+    if args.workers > 1 or args.peer or args.peer_port:
+        RESUME_GRACE = 0 # Sessions are kept in one process, a reconnect landing on another worker or server would find the nickname still taken
+    HISTORY_DIR = args.history_dir
+    HISTORY_FSYNC_INTERVAL = args.fsync_interval
+    ENGINE = args.engine
+    WORKERS = args.workers
+    if HISTORY_FSYNC_INTERVAL <= 0:
+        parser.error("--fsync-interval must be above 0")
+    SERVERADDRESS = (HOST, PORT)
+    HANDOFF_PATH = args.handoff_path
+    METRICS_PORT = args.metrics_port
+    try:
+        for limit in args.rate_limit:
+            command, _, value = limit.partition("=")
+            if command.upper() not in RATE_LIMITS:
+                raise ValueError
+            RATE_LIMITS[command.upper()] = parseRate(value)
+        CHANNEL_RATE = parseRate(args.channel_rate)
+    except ValueError:
+        parser.error("limits look like MSG=20/40 for --rate-limit (MSG, DM, JOIN or LIST) and 100/200 for --channel-rate")
+    FLOOD_STRIKES = args.flood_strikes
+    MAX_CONNECTIONS = args.max_connections
+    MAX_CONNECTIONS_PER_IP = args.max_connections_per_ip
+    LISTEN_BACKLOG = args.backlog
+    LOCK_PROFILE = args.lock_profile
+    if HANDOFF_PATH and (ENGINE != "selectors" or WORKERS > 1 or args.peer or args.peer_port):
+        parser.error("--handoff-path needs --engine selectors, a single worker and no linked servers")
+    if args.peer or args.peer_port:
+        if WORKERS > 1:
+            parser.error("--peer and --peer-port can't be combined with --workers")
+        if not args.peer_secret:
+            parser.error("--peer and --peer-port need --peer-secret, the same on every linked server")
+        PEER_HOST = args.peer_host
+        PEER_SECRET = args.peer_secret
+        try:
+            peers = [(host, int(port)) for host, port in (peer.rsplit(":", 1) for peer in args.peer)]
+        except ValueError:
+            parser.error("--peer must be given as host:port")
+        bus = PeerBus(args.node_id or f"{socket.gethostname()}:{PORT}", args.peer_port, peers)
+    if WORKERS > 1:
+        startWorkers() # History log is opened in each worker, threads don't survive fork
+    else:
+        runEngine()
@@ -0,0 +1,60 @@
+import server
+
+
+def resetAdmission(monkeypatch, total, perIp):
+    monkeypatch.setattr(server, "MAX_CONNECTIONS", total)
+    monkeypatch.setattr(server, "MAX_CONNECTIONS_PER_IP", perIp)
+    monkeypatch.setattr(server, "openConnections", 0)
+    monkeypatch.setattr(server, "connectionsPerIp", {})
+
+
+def testGlobalCap(monkeypatch):
+    resetAdmission(monkeypatch, 2, 0)
+    assert server.admitConnection(("10.0.0.1", 1)) is None
+    assert server.admitConnection(("10.0.0.2", 1)) is None
+    assert server.admitConnection(("10.0.0.3", 1)) == "Server is full, try again later"
+    server.releaseConnection(("10.0.0.1", 1))
+    assert server.admitConnection(("10.0.0.3", 1)) is None
+
+
+def testPerAddressCap(monkeypatch):
+    resetAdmission(monkeypatch, 0, 2)
+    assert server.admitConnection(("10.0.0.1", 1)) is None
+    assert server.admitConnection(("10.0.0.1", 2)) is None
+    assert server.admitConnection(("10.0.0.1", 3)) == "Too many connections from your address"
+    assert server.admitConnection(("10.0.0.2", 1)) is None # Other addresses are not affected
+    server.releaseConnection(("10.0.0.1", 1))
+    server.releaseConnection(("10.0.0.1", 2))
+    assert "10.0.0.1" not in server.connectionsPerIp # Counts don't pile up for addresses that left
+
+
+def testForceIgnoresTheCaps(monkeypatch):
+    resetAdmission(monkeypatch, 1, 1)
+    assert server.admitConnection(("10.0.0.1", 1)) is None
+    assert server.admitConnection(("10.0.0.1", 2), force=True) is None # Taken over from the old process
+    assert server.openConnections == 2
+
+
+def testRejectionSendsErrorAndCloses():
+    sock, peer = server.socket.socketpair()
+    server.rejectConnection(sock, ("10.0.0.1", 1), "Server is full, try again later")
+    data = peer.recv(4096)
+    peer.close()
+    length = server.FRAME_HEADER.unpack(data[:4])[0]
+    assert data[4:4 + length].decode("utf-8").endswith(":Server is full, try again later")
+    assert sock.fileno() == -1
+
+
+def testSlotReleasedWhenWriterThreadFails(monkeypatch):
+    resetAdmission(monkeypatch, 10, 10)
+    address = ("10.0.0.1", 1)
+    assert server.admitConnection(address) is None
+    sock, peer = server.socket.socketpair()
+
+    def failingClientSocket(rawSocket):
+        raise RuntimeError("can't start new thread")
+    monkeypatch.setattr(server, "ClientSocket", failingClientSocket)
+    server.handleClient(sock, address)
+    peer.close()
+    assert server.openConnections == 0 and server.connectionsPerIp == {}
+    assert sock.fileno() == -1 # Closed even though there was no ClientSocket to close it
@@ -0,0 +1,26 @@
+import server
+
+
+def resetChannels(monkeypatch):
+    monkeypatch.setattr(server, "channels", {"general": {}})
+    monkeypatch.setattr(server, "userChannels", {})
+
+
+def testIndexFollowsChannelMoves(monkeypatch):
+    resetChannels(monkeypatch)
+    alice, bob = object(), object()
+    server.addToChannel("alice", "general", alice)
+    server.addToChannel("bob", "general", bob)
+    server.addToChannel("alice", "games", alice) # A client is in one channel at a time
+    assert server.getUsersChannel("alice") == "games"
+    assert server.getUsersChannel("bob") == "general"
+    assert server.channels == {"general": {"bob": bob}, "games": {"alice": alice}}
+
+
+def testRemoveClearsBothSides(monkeypatch):
+    resetChannels(monkeypatch)
+    server.addToChannel("alice", "general", object())
+    assert server.removeFromChannel("alice") == "general"
+    assert server.getUsersChannel("alice") is None
+    assert server.channels["general"] == {}
+    assert server.removeFromChannel("alice") is None # Removing twice is harmless
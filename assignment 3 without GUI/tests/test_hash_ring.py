@@ -0,0 +1,39 @@
+import server
+
+
+def channelNames(count):
+    return [f"channel{i}" for i in range(count)]
+
+
+def testSameOwnerOnEveryNode():
+    nodes = ["a:3000", "b:3000", "c:3000"]
+    first = server.HashRing(nodes)
+    second = server.HashRing(list(reversed(nodes))) # Nodes learn about each other in any order
+    assert all(first.owner(name) == second.owner(name) for name in channelNames(500))
+
+
+def testSingleNodeOwnsEverything():
+    ring = server.HashRing(["a:3000"])
+    assert {ring.owner(name) for name in channelNames(100)} == {"a:3000"}
+
+
+def testChannelsAreSpread():
+    ring = server.HashRing(["a:3000", "b:3000", "c:3000", "d:3000"])
+    owners = [ring.owner(name) for name in channelNames(4000)]
+    for node in ["a:3000", "b:3000", "c:3000", "d:3000"]:
+        assert 500 < owners.count(node) < 1500 # Even enough with 64 points a node
+
+
+def testOnlyTheLeavingNodesChannelsMove():
+    before = server.HashRing(["a:3000", "b:3000", "c:3000"])
+    after = server.HashRing(["a:3000", "b:3000"])
+    for name in channelNames(1000):
+        if before.owner(name) != "c:3000":
+            assert after.owner(name) == before.owner(name)
+
+
+def testNewNodeOnlyTakesChannels():
+    before = server.HashRing(["a:3000", "b:3000"])
+    after = server.HashRing(["a:3000", "b:3000", "c:3000"])
+    moved = [name for name in channelNames(1000) if before.owner(name) != after.owner(name)]
+    assert moved and all(after.owner(name) == "c:3000" for name in moved)
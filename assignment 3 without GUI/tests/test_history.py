@@ -0,0 +1,89 @@
+import random
+
+import server
+
+
+# Same result as page() the slow way, a list of everything below beforeId cut to the newest limit entries
+def referencePage(entries, beforeId, limit):
+    older = [entry for entry in entries if beforeId is None or entry.id < beforeId]
+    if limit is None:
+        return older
+    return older[max(0, len(older) - limit):] if limit else []
+
+
+def fillHistory(capacity, ids):
+    history = server.MessageHistory(capacity)
+    for entryId in ids:
+        history.append(server.HistoryEntry("alice", f"message {entryId}", "12.00", entryId))
+    return history
+
+
+def checkAgainstReference(history, maxId, rng):
+    for _ in range(300):
+        beforeId = rng.choice([None] + list(range(-2, maxId + 3)))
+        limit = rng.choice([None, 0, 1, 3, 20, 500])
+        expected = [entry.id for entry in referencePage(history.entries, beforeId, limit)]
+        assert [entry.id for entry in history.page(beforeId, limit)] == expected, (beforeId, limit)
+
+
+def testPageMatchesReference():
+    rng = random.Random(1)
+    for capacity, count in [(5, 3), (5, 80), (50, 49), (50, 120), (1000, 1000)]:
+        history = server.MessageHistory(capacity)
+        for _ in range(count):
+            history.append(server.HistoryEntry("alice", "x", "12.00"))
+        checkAgainstReference(history, count, rng)
+
+
+def testPageWithGapsInIds():
+    rng = random.Random(2)
+    ids = [1, 2, 3, 7, 8, 20, 21, 22, 40] # Damaged records skipped on reload leave gaps
+    history = fillHistory(50, ids)
+    checkAgainstReference(history, 45, rng)
+    assert [entry.id for entry in history.page(21, 3)] == [7, 8, 20]
+
+
+def testIdsContinueAfterRestoredEntries():
+    history = fillHistory(10, [5, 6, 7])
+    history.append(server.HistoryEntry("bob", "new", "12.00"))
+    assert history.nextId == 9
+    assert history.page()[-1].id == 8
+
+
+def testRingBufferKeepsNewest():
+    history = server.MessageHistory(3)
+    for _ in range(10):
+        history.append(server.HistoryEntry("alice", "x", "12.00"))
+    assert len(history) == 3
+    assert [entry.id for entry in history.page()] == [8, 9, 10]
+
+
+# Records what would be sent, one entry per sendFrame call
+class RecordingSocket:
+    def __init__(self):
+        self.frames = []
+
+    def sendFrame(self, frame):
+        self.frames.append(frame)
+
+    def send(self, data):
+        self.sendFrame(server.frameMessage(data))
+
+
+def testHistoryMoreIsOwnLineBeforeFooter(monkeypatch):
+    monkeypatch.setattr(server, "FRAMED", False)
+    history = fillHistory(50, range(1, 31))
+    clientSocket = RecordingSocket()
+    server.sendHistory(clientSocket, "bob", history.page(None, 5), "general")
+    lines = b"".join(clientSocket.frames).decode("utf-8").split("\n")
+    assert "HISTORY_MORE:general:26" in lines # A line of its own so an unframed client can find it
+    assert lines.index("HISTORY_MORE:general:26") == len(lines) - 3 # Before the footer and the empty piece after the last newline
+    assert lines[-2].endswith("--- End History ---")
+
+
+def testNoHistoryMoreAtTheStart(monkeypatch):
+    monkeypatch.setattr(server, "FRAMED", False)
+    history = fillHistory(50, range(1, 4))
+    clientSocket = RecordingSocket()
+    server.sendHistory(clientSocket, "bob", history.page(None, 5), "general")
+    assert b"HISTORY_MORE" not in b"".join(clientSocket.frames)
@@ -0,0 +1,66 @@
+import glob
+import os
+
+import server
+
+
+def writeEntries(directory, ids, segmentSize=server.HISTORY_SEGMENT_SIZE, channel="general"):
+    historyLog = server.HistoryLog(directory, segmentSize=segmentSize, fsyncInterval=0.1)
+    for entryId in ids:
+        historyLog.append(channel, server.HistoryEntry("alice", f"message {entryId}", "12.00", entryId))
+    historyLog.close() # Everything queued is on disk after this
+    return historyLog
+
+
+def segmentSizes(directory):
+    return [os.path.getsize(path) for path in sorted(glob.glob(os.path.join(directory, "*", "*.log")))]
+
+
+def testReplayAfterRestart(tmp_path):
+    writeEntries(str(tmp_path), range(1, 51))
+    historyLog = server.HistoryLog(str(tmp_path))
+    entries = historyLog.readTail("general", 100)
+    historyLog.close()
+    assert [entry.id for entry in entries] == list(range(1, 51))
+    assert entries[0].sender == "alice" and entries[0].message == "message 1"
+
+
+def testRotationKeepsSegmentsUnderTheCap(tmp_path):
+    writeEntries(str(tmp_path), range(1, 101), segmentSize=300) # One batch, the writer has to rotate in the middle of it
+    sizes = segmentSizes(str(tmp_path))
+    assert len(sizes) > 1
+    assert max(sizes) <= 300
+
+
+def testReadBeforeAcrossSegments(tmp_path):
+    writeEntries(str(tmp_path), range(1, 101), segmentSize=300)
+    historyLog = server.HistoryLog(str(tmp_path), segmentSize=300)
+    assert [entry.id for entry in historyLog.readTail("general", 100)] == list(range(1, 101))
+    assert [entry.id for entry in historyLog.readBefore("general", 50, 7)] == list(range(43, 50))
+    assert historyLog.readBefore("general", 1, 10) == []
+    historyLog.close()
+
+
+def testDamagedRecordIsSkipped(tmp_path):
+    writeEntries(str(tmp_path), range(1, 11))
+    path = glob.glob(os.path.join(str(tmp_path), "*", "*.log"))[0]
+    with open(path, "rb") as logFile:
+        lines = logFile.read().split(b"\n")
+    lines[4] = lines[4][:10] # Record of id 5 cut short, like after a full disk
+    lines[6] = b'{"time": "12.00"}' # Valid JSON but not a record
+    with open(path, "wb") as logFile:
+        logFile.write(b"\n".join(lines))
+    historyLog = server.HistoryLog(str(tmp_path))
+    assert [entry.id for entry in historyLog.readTail("general", 20)] == [1, 2, 3, 4, 6, 8, 9, 10]
+    historyLog.close()
+
+
+def testChannelsAreKeptApart(tmp_path):
+    historyLog = server.HistoryLog(str(tmp_path), fsyncInterval=0.1)
+    historyLog.append("general", server.HistoryEntry("alice", "hello", "12.00", 1))
+    historyLog.append("a/b c", server.HistoryEntry("bob", "other", "12.00", 1)) # Any character is allowed in a channel name
+    historyLog.close()
+    historyLog = server.HistoryLog(str(tmp_path))
+    assert [entry.message for entry in historyLog.readTail("general", 10)] == ["hello"]
+    assert [entry.message for entry in historyLog.readTail("a/b c", 10)] == ["other"]
+    historyLog.close()
@@ -0,0 +1,86 @@
+import json
+import threading
+
+import pytest
+
+import server
+
+
+# Two ends of a TCP connection over loopback, runLink sets TCP options so a Unix socket pair doesn't do
+def connectedPair():
+    listener = server.socket.create_server(("127.0.0.1", 0))
+    theirs = server.socket.create_connection(listener.getsockname())
+    ours, address = listener.accept()
+    listener.close()
+    return ours, theirs
+
+
+# Starts the accepting side of a link on one end of a socket pair, the test plays the other node on the other end
+def acceptLink(monkeypatch):
+    monkeypatch.setattr(server, "PEER_SECRET", "s3cret")
+    monkeypatch.setattr(server, "clients", {})
+    monkeypatch.setattr(server, "userChannels", {})
+    monkeypatch.setattr(server, "remoteUsers", {})
+    peerBus = server.PeerBus("a:3000", None, [])
+    peerBus.dispatch = lambda message: None
+    ours, theirs = connectedPair()
+    theirs.settimeout(5)
+    thread = threading.Thread(target=peerBus.runLink, args=(ours, False))
+    thread.daemon = True
+    thread.start()
+    return peerBus, theirs, thread
+
+
+def sendHello(sock, secret):
+    sock.sendall(json.dumps({"type": "hello", "secret": secret, "origin": "b:3000"}).encode("utf-8") + b"\n")
+
+
+def receiveAll(sock):
+    data = b""
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def testWrongSecretIsRejected(monkeypatch):
+    peerBus, theirs, thread = acceptLink(monkeypatch)
+    sendHello(theirs, "guess")
+    assert receiveAll(theirs) == b"" # Closed without answering, the secret never goes to a stranger
+    thread.join(5)
+    assert peerBus.links == {}
+    theirs.close()
+
+
+def testMissingSecretIsRejected(monkeypatch):
+    peerBus, theirs, thread = acceptLink(monkeypatch)
+    theirs.sendall(json.dumps({"type": "hello", "origin": "b:3000"}).encode("utf-8") + b"\n")
+    assert receiveAll(theirs) == b""
+    thread.join(5)
+    assert peerBus.links == {}
+    theirs.close()
+
+
+def testRightSecretLinks(monkeypatch):
+    peerBus, theirs, thread = acceptLink(monkeypatch)
+    sendHello(theirs, "s3cret")
+    lines = server.readLines(theirs)
+    hello = next(lines)
+    assert hello["type"] == "hello" and hello["origin"] == "a:3000"
+    assert next(lines)["type"] == "gone" # Followed by the clients of the node
+    assert "b:3000" in peerBus.links
+    assert peerBus.ownerOf("general") in ("a:3000", "b:3000")
+    theirs.close()
+    thread.join(5)
+    assert peerBus.links == {} # Link is forgotten when it drops
+
+
+def testOverlongLineIsRefused(monkeypatch):
+    monkeypatch.setattr(server, "MAX_LINE", 100)
+    ours, theirs = server.socket.socketpair()
+    theirs.sendall(b"x" * 500)
+    theirs.close()
+    with pytest.raises(ValueError):
+        list(server.readLines(ours))
+    ours.close()
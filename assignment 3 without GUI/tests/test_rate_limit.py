@@ -0,0 +1,70 @@
+import server
+
+
+# Clock for the token buckets that only moves when the test says so
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+# Stand-in for a client socket, only what the rate limits look at
+class FakeSocket:
+    def __init__(self):
+        self.buckets = {}
+
+
+def testBurstThenRate(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    bucket = server.TokenBucket(2, 5)
+    assert [bucket.take() for _ in range(6)] == [True] * 5 + [False]
+    clock.now += 1 # Two more tokens
+    assert [bucket.take() for _ in range(3)] == [True, True, False]
+    clock.now += 100 # Never more than the burst
+    assert sum(bucket.take() for _ in range(10)) == 5
+
+
+def testLimitsArePerCommandAndPerClient(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    monkeypatch.setattr(server, "RATE_LIMITS", {"MSG": (1, 3), "JOIN": (1, 1)})
+    alice, bob = FakeSocket(), FakeSocket()
+    assert [server.allowCommand("MSG", alice) for _ in range(4)] == [True, True, True, False]
+    assert server.allowCommand("JOIN", alice) # Own bucket for each command
+    assert server.allowCommand("MSG", bob) # And for each client
+    assert all(server.allowCommand("DM", alice) for _ in range(100)) # No limit set
+
+
+def testZeroRateTurnsTheLimitOff(monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMITS", {"MSG": (0, 0)})
+    alice = FakeSocket()
+    assert all(server.allowCommand("MSG", alice) for _ in range(1000))
+    assert alice.buckets == {}
+
+
+def testChannelBudgetIsShared(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    monkeypatch.setattr(server, "CHANNEL_RATE", (1, 2))
+    monkeypatch.setattr(server, "channelBuckets", {})
+    assert [server.allowChannelMessage("general") for _ in range(3)] == [True, True, False]
+    assert server.allowChannelMessage("games")
+
+
+def testFloodStrikesDisconnect(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(server.time, "monotonic", clock)
+    monkeypatch.setattr(server, "FLOOD_STRIKES", 3)
+    monkeypatch.setattr(server, "FLOOD_WINDOW", 10)
+    alice = FakeSocket()
+    assert [server.floodStrike(alice) for _ in range(4)] == [False, False, False, True]
+    clock.now += 10 # Strikes wear off
+    assert not server.floodStrike(alice)
+
+
+def testParseRate():
+    assert server.parseRate("5") == (5.0, 10.0)
+    assert server.parseRate("5/20") == (5.0, 20.0)
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import server
+
+
+# Stand-in for a connected client's socket, keeps what the server sent as text
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+        self.nickname = None
+        self.lastActivity = time.time()
+        self.buckets = {}
+
+    def send(self, data):
+        self.sent.append(data.decode("utf-8"))
+        return len(data)
+
+    def sendFrame(self, frame):
+        self.sent.extend(line.rstrip("\n") for line in server.FrameBuffer().feed(frame)) # A history replay is several frames in one
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+    def token(self):
+        return [line for line in self.sent if line.startswith("SESSION:")][-1].split(":", 1)[1]
+
+
+def resetServer(monkeypatch):
+    monkeypatch.setattr(server, "RESUME_GRACE", 60)
+    monkeypatch.setattr(server, "stopping", False)
+    monkeypatch.setattr(server, "FRAMED", True)
+    monkeypatch.setattr(server, "bus", None)
+    monkeypatch.setattr(server, "historyLog", None)
+    monkeypatch.setattr(server, "idleTimers", server.TimerWheel(1))
+    monkeypatch.setattr(server, "clients", {})
+    monkeypatch.setattr(server, "nicknameIndex", {})
+    monkeypatch.setattr(server, "sessions", {})
+    monkeypatch.setattr(server, "channels", {"general": {}})
+    monkeypatch.setattr(server, "userChannels", {})
+    monkeypatch.setattr(server, "channelLocks", {"general": threading.Lock()})
+    monkeypatch.setattr(server, "messageHistory", {})
+
+
+def login(nickname):
+    clientSocket = FakeSocket()
+    assert server.registerNickname(f"NICKNAME:{nickname}", clientSocket) == nickname
+    server.joinDefaultChannel(nickname, clientSocket)
+    return clientSocket
+
+
+def testResumeReplaysMissedMessages(monkeypatch):
+    resetServer(monkeypatch)
+    alice = login("alice")
+    bob = login("bob")
+    server.broadcast("before", "general", "bob", bob)
+    server.dropClient("alice", alice)
+    assert "alice" in server.clients and server.getUsersChannel("alice") is None # Nickname kept, quietly out of the channel
+    server.broadcast("while away", "general", "bob", bob)
+    server.privatemessage("psst", "bob", "alice", bob)
+    again = FakeSocket()
+    assert server.registerNickname(f"RESUME:{alice.token()}", again) == "alice"
+    assert server.getUsersChannel("alice") == "general"
+    assert server.clients["alice"]["socket"] is again
+    assert any(line.endswith("Welcome back alice") for line in again.sent)
+    assert any(line.startswith("PRIVATE:") and line.endswith(":bob:psst") for line in again.sent)
+    history = [line for line in again.sent if line.startswith("HISTORY:")]
+    assert len(history) == 1 and history[0].endswith(":bob:while away") # Only what was said while away
+
+
+def testTokenWorksOnce(monkeypatch):
+    resetServer(monkeypatch)
+    alice = login("alice")
+    token = alice.token()
+    server.dropClient("alice", alice)
+    again = FakeSocket()
+    assert server.registerNickname(f"RESUME:{token}", again) == "alice"
+    assert again.token() != token
+    thief = FakeSocket()
+    assert server.registerNickname(f"RESUME:{token}", thief) is None
+    assert thief.sent[-1].endswith("Session expired, log in with your nickname")
+
+
+def testExpiredSessionFreesTheNickname(monkeypatch):
+    resetServer(monkeypatch)
+    alice = login("alice")
+    server.dropClient("alice", alice)
+    session = server.sessions[alice.token()]
+    server.expireSession(session)
+    assert "alice" not in server.clients and server.sessions == {}
+    assert server.registerNickname(f"RESUME:{alice.token()}", FakeSocket()) is None
+    login("alice") # Anyone can take it again
+
+
+def testNoParkingWhileStopping(monkeypatch):
+    resetServer(monkeypatch)
+    alice = login("alice")
+    monkeypatch.setattr(server, "stopping", True)
+    server.dropClient("alice", alice)
+    assert "alice" not in server.clients and server.sessions == {}
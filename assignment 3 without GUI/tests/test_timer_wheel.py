@@ -0,0 +1,86 @@
+import time
+
+import server
+
+
+def testExpiresOnlyWhatIsDue():
+    wheel = server.TimerWheel(1)
+    now = time.time()
+    wheel.schedule("soon", now + 2)
+    wheel.schedule("later", now + 10)
+    assert wheel.expire(now) == []
+    assert wheel.expire(now + 3) == ["soon"]
+    assert wheel.expire(now + 3) == [] # Taken out only once
+    assert wheel.expire(now + 11) == ["later"]
+
+
+def testPastDeadlineGoesToTheNextTick():
+    wheel = server.TimerWheel(1)
+    now = time.time()
+    wheel.expire(now)
+    wheel.schedule("late", now - 30) # Ticks that already passed are never looked at again
+    assert wheel.expire(now + 1) == ["late"]
+
+
+def testSkippedTicksAreExpiredToo():
+    wheel = server.TimerWheel(1)
+    now = time.time()
+    for i in range(1, 6):
+        wheel.schedule(i, now + i)
+    assert sorted(wheel.expire(now + 100)) == [1, 2, 3, 4, 5] # The checker thread was late, nothing is lost
+
+
+# Stand-in for a connected client's socket
+class FakeSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+        self.nickname = None
+        self.lastActivity = time.time()
+        self.buckets = {}
+
+    def send(self, data):
+        self.sent.append(data.decode("utf-8"))
+        return len(data)
+
+    def sendFrame(self, frame):
+        self.sent.append(frame.decode("utf-8"))
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.closed = True
+
+
+# Fresh server state with a wheel whose clock is a few ticks behind, so deadlines in the past come due on the next expire
+def resetClients(monkeypatch):
+    wheel = server.TimerWheel(1)
+    wheel.currentTick -= 5
+    monkeypatch.setattr(server, "idleTimers", wheel)
+    monkeypatch.setattr(server, "clients", {})
+    monkeypatch.setattr(server, "nicknameIndex", {})
+    monkeypatch.setattr(server, "sessions", {})
+    return wheel
+
+
+def testIdleClientIsDisconnectedAndClosed(monkeypatch):
+    wheel = resetClients(monkeypatch)
+    clientSocket = FakeSocket()
+    assert server.registerNickname("NICKNAME:alice", clientSocket) == "alice"
+    clientSocket.lastActivity -= server.clientTimeout + 5
+    wheel.schedule(clientSocket, clientSocket.lastActivity + server.clientTimeout)
+    server.disconnectInactiveClients()
+    assert "alice" not in server.clients
+    assert clientSocket.sent[-1].endswith("Disconnected due to inactivity")
+    assert clientSocket.closed # The connection ends too, not only the nickname
+
+
+def testActiveClientIsRescheduled(monkeypatch):
+    wheel = resetClients(monkeypatch)
+    clientSocket = FakeSocket()
+    server.registerNickname("NICKNAME:alice", clientSocket)
+    wheel.schedule(clientSocket, clientSocket.lastActivity - server.clientTimeout) # Came due, but the client sent something since
+    server.disconnectInactiveClients()
+    assert "alice" in server.clients and not clientSocket.closed
+    assert clientSocket in wheel.expire(clientSocket.lastActivity + server.clientTimeout + 1)